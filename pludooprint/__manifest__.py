@@ -18,9 +18,18 @@
     "author": "Jeevanism@CodeWasher",
     "website": "https://www.jeevanism.com",
     "images": ["static/description/icon.png"],
-    "depends": ["base","web"],
+    "depends": ["base","web","bus"],
     "data": [
+        "security/ir.model.access.csv",
+        "security/pludooprint_security.xml",
+        "data/ir_cron.xml",
+        "data/report_templates.xml",
     ],
+    "assets": {
+        "web.assets_backend": [
+            "pludooprint/static/src/**/*",
+        ],
+    },
     "external_dependencies": {
         "python": ["plutoprint"]
     },
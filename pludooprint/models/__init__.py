@@ -1 +1,6 @@
 from . import ir_actions_report_pluto
+from . import report_paperformat
+from . import pludooprint_report_stat
+from . import pludooprint_report_job
+from . import ir_attachment
+from . import ir_http
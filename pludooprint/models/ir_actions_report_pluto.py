@@ -1,18 +1,41 @@
+import base64
+import hashlib
 import io
 import logging
-from typing import Dict, List, Optional
-import requests
+import os
+import re
+import threading
+import time
+from typing import BinaryIO, Dict, List, Optional
 import urllib.parse
 from collections import OrderedDict
-from PIL import Image
+from contextvars import ContextVar
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
-from odoo import api, models, tools, _
+from odoo import SUPERUSER_ID, api, models, tools, _
+from odoo.addons.base.models.ir_actions_report import IrActionsReport as BaseIrActionsReport
 from odoo.exceptions import UserError
 from odoo.http import request, root
-from odoo.service import security
+from odoo.service import security, server as odoo_server
+from odoo.tools.safe_eval import safe_eval, time as safe_time
 from odoo.tools.pdf import PdfFileReader, PdfFileWriter
 
-from .plutoprint_helpers import build_engine_css, inject_css
+from .plutoprint_assets import (
+    fetch_remote, fetch_remote_many, get_http_session, lean_stylesheet, resolve_local_asset,
+)
+from .plutoprint_cache import ASSET_CACHE, CachedResource, LRUCache, PdfResultCache, asset_cache_key, get_pdf_cache
+from .plutoprint_engine import (
+    RenderBudget, RenderBudgetExceeded, RenderProfile, SpooledPdfStream, absolute_url, build_render_profile,
+    check_page_budget, new_book, render_in_pool, write_pdf_to, write_png_pages,
+)
+from .plutoprint_fonts import FONT_REGISTRY, font_key
+from .plutoprint_helpers import (
+    chunk_html_articles, effective_landscape, extract_resource_urls, group_html_articles, inject_css,
+    split_html_articles, strip_html_for_print,
+)
+from .plutoprint_images import ImagePolicy, images_to_pdf, optimize_data_uri, optimize_image
+from .plutoprint_metrics import RenderStats, count, record_fetch, stage, track_render
 
 _logger = logging.getLogger(__name__)
 
@@ -23,10 +46,109 @@ except Exception as e:
     HAS_PLUTOPRINT = False
     _logger.exception("PlutoPrint import failed: %s", e)
 
+# t-call of a template given by name; calls through an expression are not followed.
+_T_CALL_RE = re.compile(r"""\bt-call=["']([\w.]+)["']""")
+
+_ASSET_SESSIONS: Dict[tuple, tuple] = {}
+_ASSET_SESSIONS_LOCK = threading.Lock()
+
+# PNG previews by database, report, record and write_date (see _pluto_preview_png).
+PREVIEW_CACHE = LRUCache(32 * 1024 * 1024)
+
+_WARMED_UP: set = set()
+_WARMED_UP_LOCK = threading.Lock()
+# Databases whose warm-up is started in every forked prefork worker.
+_WARM_UP_AFTER_FORK: set = set()
+
+# (report id, {res_id: attachment}) found by the batch search of
+# _pluto_retrieve_attachments, for the retrieve_attachment() calls it makes.
+_PREFETCHED_ATTACHMENTS: ContextVar[Optional[tuple]] = ContextVar("pludooprint_attachments", default=None)
+
+
+def _in_prefork_master() -> bool:
+    # Worker processes are forked from the master and keep its server object.
+    server = odoo_server.server
+    return isinstance(server, odoo_server.PreforkServer) and server.pid == os.getpid()
+
+
+def _start_warm_up(registry):
+    # Once per process and database, in a background thread.
+    key = (os.getpid(), registry.db_name)
+    with _WARMED_UP_LOCK:
+        if key in _WARMED_UP:
+            return
+        _WARMED_UP.add(key)
+    threading.Thread(target=_warm_up_when_ready, args=(registry,),
+                     name="pludooprint-warmup", daemon=True).start()
+
+
+def _warm_up_forked_worker():
+    # Only in the master's direct children (HTTP and cron workers), not in the
+    # render pools those workers fork in turn.
+    server = odoo_server.server
+    if not isinstance(server, odoo_server.PreforkServer) or os.getppid() != server.pid:
+        return
+    from odoo.modules.registry import Registry
+    for dbname in list(_WARM_UP_AFTER_FORK):
+        registry = Registry.registries.get(dbname)
+        if registry is not None:
+            _start_warm_up(registry)
+
+
+def _warm_up_when_ready(registry, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while not registry.ready and time.monotonic() < deadline:
+        time.sleep(0.5)
+    try:
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env["ir.actions.report"]._pluto_warm_up()
+    except Exception:
+        _logger.warning("PlutoPrint warm-up failed for database %s", registry.db_name, exc_info=True)
+
 
 class IrActionsReportPluto(models.Model):
     _inherit = "ir.actions.report"
 
+    def _register_hook(self):
+        super()._register_hook()
+        self._pluto_schedule_warm_up()
+
+    def _pluto_schedule_warm_up(self):
+        # Opt-in (pludooprint.warmup): once the registry is loaded, render a
+        # reference document in the background so the worker's first real report
+        # finds the engine, assets and fonts ready.
+        if not HAS_PLUTOPRINT or tools.config["test_enable"] or tools.config.get("init") or tools.config.get("update"):
+            return
+        if not tools.str2bool(self.env["ir.config_parameter"].sudo().get_param("pludooprint.warmup", "False")):
+            return
+        if _in_prefork_master():
+            # With a preloaded database (-d/db_name) the registry is loaded here,
+            # in the master, and workers inherit it through fork without
+            # running _register_hook again: warm up in each worker after fork.
+            with _WARMED_UP_LOCK:
+                if not _WARM_UP_AFTER_FORK:
+                    os.register_at_fork(after_in_child=_warm_up_forked_worker)
+                _WARM_UP_AFTER_FORK.add(self.env.cr.dbname)
+            return
+        _start_warm_up(self.env.registry)
+
+    @api.model
+    def _pluto_warm_up(self):
+        with track_render("pludooprint.warmup") as stats:
+            with stage("qweb"):
+                html = self._render_template("pludooprint.report_warmup_document", {"docs": self.env.company})
+            paperformat = self.env.company.paperformat_id
+            doc = self._pluto_prepare_document(html, self._get_pluto_render_profile(paperformat).engine_css)
+            self.with_context(pludooprint_no_pdf_cache=True)._render_with_plutoprint(
+                doc, self._build_cookie_header_for_assets(), paperformat=paperformat)
+        summary = stats.summary()
+        _logger.info(
+            "PlutoPrint warm-up done in %s ms (fetches=%s fonts=%s)",
+            summary["total_ms"], summary["fetch_count"], FONT_REGISTRY.stats()["entries"],
+        )
+        return summary
+
     def _get_layout(self):
         return self.env.ref("plutoprint.minimal_layout_pluto", raise_if_not_found=False) or super()._get_layout()
 
@@ -43,11 +165,37 @@ class IrActionsReportPluto(models.Model):
         self = self.with_context(webp_as_jpg=True)
         return self._render_qweb_pdf_prepare_streams(report_ref, data, res_ids=res_ids), 'pdf'
 
+    def _pluto_should_queue(self, res_ids) -> bool:
+        threshold = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.queue_threshold", 0))
+        if threshold <= 0 or not res_ids or len(res_ids) < threshold:
+            return False
+        return not self.env.context.get("pludooprint_in_queue")
+
+    @api.model
+    def enqueue_plutoprint_report(self, report_ref, res_ids, data=None):
+        # Called by the web client before downloading a PDF report (see
+        # static/src/report_queue.js): large batches are queued and the client
+        # shows a notification instead of waiting. Mail, portal and server-side
+        # callers never come through here and get the PDF synchronously.
+        # Returns the job id, or False when the report should be downloaded.
+        report = self._get_report(report_ref)
+        if report.report_type != "qweb-pdf" or not self._pluto_should_queue(res_ids):
+            return False
+        self.env[report.model].browse(res_ids).check_access("read")
+        return self.env["pludooprint.report.job"]._enqueue(report, res_ids, data).id
+
     def _render_qweb_pdf_prepare_streams(self, report_ref, data, res_ids=None):
         if not HAS_PLUTOPRINT:
             raise UserError(
                 _("PlutoPrint is not available in this environment. Please install and restart workers."))
 
+        report_sudo = self._get_report(report_ref)
+        with track_render(report_sudo.report_name) as stats:
+            collected_streams = self._pluto_prepare_streams(report_ref, data, res_ids=res_ids)
+        self._pluto_report_stats(report_sudo, stats, res_ids)
+        return collected_streams
+
+    def _pluto_prepare_streams(self, report_ref, data, res_ids=None):
         if not data:
             data = {}
         data.setdefault('report_type', 'pdf')
@@ -59,25 +207,30 @@ class IrActionsReportPluto(models.Model):
         collected_streams = OrderedDict()
         if res_ids:
             records = self.env[report_sudo.model].browse(res_ids)
+            attachments = {}
+            if (not has_duplicated_ids and report_sudo.attachment
+                    and not self._context.get("report_pdf_no_attachment")):
+                with stage("attachments"):
+                    attachments = self._pluto_retrieve_attachments(report_sudo, records)
+            image_attachments = {}
             for record in records:
                 rid = record.id
                 if rid in collected_streams:
                     continue
                 stream = None
-                attachment = None
-                if (not has_duplicated_ids and report_sudo.attachment
-                        and not self._context.get("report_pdf_no_attachment")):
-                    attachment = report_sudo.retrieve_attachment(record)
-                    if attachment and report_sudo.attachment_use:
+                attachment = attachments.get(rid)
+                if attachment and report_sudo.attachment_use:
+                    if attachment.mimetype and attachment.mimetype.startswith("image"):
+                        image_attachments[rid] = attachment
+                    else:
                         stream = io.BytesIO(attachment.raw or b"")
-                        if attachment.mimetype and attachment.mimetype.startswith("image"):
-                            img = Image.open(stream)
-                            new_stream = io.BytesIO()
-                            img.convert("RGB").save(new_stream, format="PDF")
-                            stream.close()
-                            stream = new_stream
                 collected_streams[rid] = {
                     "stream": stream, "attachment": attachment}
+            if image_attachments:
+                with stage("attachments"):
+                    pdfs = self._pluto_images_to_pdf(report_ref, list(image_attachments.values()))
+                for rid, pdf in zip(image_attachments, pdfs):
+                    collected_streams[rid]["stream"] = io.BytesIO(pdf)
 
         res_ids_wo_stream = [rid for rid, data_ in collected_streams.items() if not data_[
             "stream"]]
@@ -89,14 +242,15 @@ class IrActionsReportPluto(models.Model):
 
         add_ctx = {"debug": False}
         data.setdefault("debug", False)
-        full_html = self.with_context(
-            **add_ctx)._render_qweb_html(report_ref, all_res_ids_wo_stream, data=data)[0]
+        with stage("qweb"):
+            full_html = self.with_context(
+                **add_ctx)._render_qweb_html(report_ref, all_res_ids_wo_stream, data=data)[0]
+        count("html_bytes", len(full_html))
 
-        unused_body, html_ids, unused_header, unused_footer, specific = self.with_context(**add_ctx)._prepare_html(
-            full_html, report_model=report_sudo.model
-        )
-        if _logger.isEnabledFor(logging.DEBUG):
-            _logger.debug("PlutoPrint render HTML bytes: %s", len(full_html))
+        with stage("prepare_html"):
+            unused_body, html_ids, unused_header, unused_footer, specific = self.with_context(**add_ctx)._prepare_html(
+                full_html, report_model=report_sudo.model
+            )
 
         if (not has_duplicated_ids and report_sudo.attachment
                 and set(res_ids_wo_stream) != set([x for x in html_ids if x])):
@@ -108,57 +262,323 @@ class IrActionsReportPluto(models.Model):
             ))
 
         paperformat = self._resolve_paperformat(report_ref)
-        engine_css = build_engine_css(
-            paperformat, specific, landscape=self._context.get("landscape")
-        )
+        engine_css = self._get_pluto_render_profile(paperformat, specific).engine_css
 
         cookie_header = self._build_cookie_header_for_assets()
 
-        per_body_streams: List[io.BytesIO] = []
+        rid_to_doc = None
+        if res_ids and not has_duplicated_ids:
+            with stage("split"):
+                rid_to_doc = self._map_article_docs(full_html, html_ids, res_ids_wo_stream)
 
-        if has_duplicated_ids or not res_ids:
-            doc = inject_css(full_html, [engine_css])
-            per_body_streams.append(io.BytesIO(
-                self._render_with_plutoprint(doc, cookie_header, paperformat=paperformat)))
-        else:
-            for rid in res_ids_wo_stream:
-                doc = inject_css(full_html, [engine_css])
-                pdf_bytes = self._render_with_plutoprint(
-                    doc, cookie_header, paperformat=paperformat)
-                per_body_streams.append(io.BytesIO(pdf_bytes))
-
-        if has_duplicated_ids or not res_ids:
-            merged = self._merge_streams(per_body_streams)
+        if rid_to_doc is None:
+            chunk_kb = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.chunk_max_kb", 0))
+            if chunk_kb > 0 and len(full_html) > chunk_kb * 1024:
+                merged = self._render_chunked_with_plutoprint(
+                    full_html, engine_css, cookie_header, paperformat, chunk_kb * 1024)
+                return {False: {"stream": merged, "attachment": None}}
+            doc = self._pluto_prepare_document(full_html, engine_css)
+            stream = self._render_with_plutoprint(doc, cookie_header, paperformat=paperformat)
+            merged = self._merge_streams([stream])
             return {False: {"stream": merged, "attachment": None}}
 
-        if len(per_body_streams) == len(res_ids_wo_stream):
-            for i, rid in enumerate(res_ids_wo_stream):
-                collected_streams[rid]["stream"] = per_body_streams[i]
-            return collected_streams
+        rid_to_paperformat = self._pluto_record_paperformats(report_sudo, res_ids_wo_stream, paperformat)
+        engine_css_by_format = {paperformat: engine_css}
+        for record_paperformat in set(rid_to_paperformat.values()) - {paperformat}:
+            engine_css_by_format[record_paperformat] = self._get_pluto_render_profile(
+                record_paperformat, specific).engine_css
+        docs = [self._pluto_prepare_document(rid_to_doc[rid], engine_css_by_format[rid_to_paperformat[rid]])
+                for rid in res_ids_wo_stream]
+        streams = self._render_many_with_plutoprint(
+            docs, cookie_header, paperformat=paperformat,
+            paperformats=[rid_to_paperformat[rid] for rid in res_ids_wo_stream])
+        for rid, stream in zip(res_ids_wo_stream, streams):
+            collected_streams[rid]["stream"] = stream
+        return collected_streams
 
-        html_ids_wo_none = [x for x in html_ids if x]
-        if len(html_ids_wo_none) == len(per_body_streams) and set(html_ids_wo_none) == set(res_ids_wo_stream):
-            rid_to_index = {rid: idx for idx,
-                            rid in enumerate(html_ids_wo_none)}
-            for rid in res_ids_wo_stream:
-                collected_streams[rid]["stream"] = per_body_streams[rid_to_index[rid]]
-            return collected_streams
+    def _render_chunked_with_plutoprint(self, full_html: bytes, engine_css: str, cookie_header: Optional[str],
+                                        paperformat, max_bytes: int) -> io.BytesIO:
+        # Lay out one chunk at a time so the engine never holds the whole
+        # document's layout. This only bounds the engine: every chunk's PDF is
+        # kept (spooled to disk past pludooprint.spool_max_size_mb) until the
+        # final merge, and the merge holds all pages in one pypdf writer, so
+        # its memory still grows with the document.
+        # The time and page budgets apply to the whole document: each chunk
+        # gets what the previous ones left of them.
+        budget = self._pluto_render_budget()
+        deadline = time.monotonic() + budget.seconds if budget.seconds > 0 else False
+        pages_left = budget.pages
+        streams = []
+        try:
+            for chunk in chunk_html_articles(full_html, max_bytes):
+                if budget.pages and pages_left <= 0:
+                    raise UserError(_("This document is too long to print: %s.",
+                                      _("more than %s pages", budget.pages)))
+                stream = self.with_context(
+                    pludooprint_render_deadline=deadline, pludooprint_render_pages=pages_left,
+                )._render_with_plutoprint(
+                    self._pluto_prepare_document(chunk, engine_css), cookie_header, paperformat=paperformat)
+                streams.append(stream)
+                if budget.pages:
+                    stream.seek(0)
+                    pages_left -= PdfFileReader(stream).numPages
+                    stream.seek(0)
+                count("chunks")
+        except Exception:
+            for spool in streams:
+                spool.close()
+            raise
+        return self._merge_streams(streams)
+
+    def _pluto_retrieve_attachments(self, report_sudo, records) -> Dict[int, models.BaseModel]:
+        # retrieve_attachment() for a whole batch, with the stock lookup by
+        # attachment name done in a single search. Modules that override
+        # retrieve_attachment (e.g. account for vendor bills) still get called
+        # for each record, and their super() is answered from that search.
+        names = {}
+        for record in records:
+            name = safe_eval(report_sudo.attachment, {"object": record, "time": safe_time})
+            if name:
+                names[record.id] = name
+        found = {}
+        if names:
+            for attachment in report_sudo.env["ir.attachment"].search([
+                ("name", "in", list(set(names.values()))),
+                ("res_model", "=", report_sudo.model),
+                ("res_id", "in", list(names)),
+            ]):
+                if names[attachment.res_id] == attachment.name:
+                    found.setdefault(attachment.res_id, attachment)
+        if type(report_sudo).retrieve_attachment is IrActionsReportPluto.retrieve_attachment:
+            return found
+        token = _PREFETCHED_ATTACHMENTS.set((report_sudo.id, found))
+        try:
+            retrieved = {record.id: report_sudo.retrieve_attachment(record) for record in records}
+        finally:
+            _PREFETCHED_ATTACHMENTS.reset(token)
+        return {rid: attachment for rid, attachment in retrieved.items() if attachment}
+
+    def retrieve_attachment(self, record):
+        # See _pluto_retrieve_attachments. An override sitting below this class
+        # in the MRO would be skipped by the prefetched answer: then the stock
+        # lookup runs as usual.
+        prefetched = _PREFETCHED_ATTACHMENTS.get()
+        if prefetched is None or prefetched[0] != self.id or self._pluto_overridden_below():
+            return super().retrieve_attachment(record)
+        return prefetched[1].get(record.id)
+
+    @classmethod
+    def _pluto_overridden_below(cls) -> bool:
+        mro = cls.__mro__
+        below = mro[mro.index(IrActionsReportPluto) + 1:mro.index(BaseIrActionsReport)]
+        return any("retrieve_attachment" in vars(klass) for klass in below)
+
+    def _pluto_template_version(self, report_name: str):
+        # Latest change to the report's QWeb view, to the templates it t-calls
+        # by name (e.g. the *_document template, web.external_layout), and to
+        # every view inheriting from one of those. Layouts picked by an
+        # expression, like the company's external_report_layout_id, are not
+        # followed: switching or editing them does not make stored PDFs stale.
+        View = self.env["ir.ui.view"].sudo().with_context(active_test=False)
+        views = View.browse()
+        keys, seen = {report_name}, set()
+        while keys:
+            seen |= keys
+            todo = View.search([("key", "in", list(keys))]) - views
+            keys = set()
+            while todo:
+                views |= todo
+                for view in todo:
+                    keys.update(_T_CALL_RE.findall(view.arch_db or ""))
+                todo = todo.inherit_children_ids - views
+            keys -= seen
+        return max(views.mapped("write_date"), default=None)
+
+    def _pluto_fingerprints(self, report_sudo, records) -> Dict[int, str]:
+        # What a stored PDF depends on: the record's write_date, the template
+        # version and the paperformat the record is printed on (see
+        # _pluto_record_paperformats). Prefixed with the report id so the stale
+        # scan can find the attachments of one report.
+        template_version = self._pluto_template_version(report_sudo.report_name)
+        paperformats = self._pluto_record_paperformats(
+            report_sudo, records.ids, self._resolve_paperformat(report_sudo))
+        fingerprints = {}
+        for record in records:
+            paperformat = paperformats[record.id]
+            inputs = f"{template_version}|{paperformat.id}|{paperformat.write_date}|{record.write_date}"
+            fingerprints[record.id] = f"{report_sudo.id}:" + hashlib.sha1(inputs.encode()).hexdigest()
+        return fingerprints
+
+    @api.model
+    def _prepare_pdf_report_attachment_vals_list(self, report, streams):
+        vals_list = super()._prepare_pdf_report_attachment_vals_list(report, streams)
+        if vals_list:
+            fingerprints = self._pluto_fingerprints(
+                report, self.env[report.model].browse([vals["res_id"] for vals in vals_list]))
+            for vals in vals_list:
+                vals["pludooprint_fingerprint"] = fingerprints.get(vals["res_id"])
+        return vals_list
+
+    def _pluto_stale_attachments(self):
+        # Stored PDFs of this report whose inputs changed since they were
+        # rendered. Attachments saved before fingerprinting are not tracked.
+        self.ensure_one()
+        attachments = self.env["ir.attachment"].sudo().search([
+            ("res_model", "=", self.model),
+            ("pludooprint_fingerprint", "=like", f"{self.id}:%"),
+        ])
+        if not attachments:
+            return attachments
+        records = self.env[self.model].sudo().browse(list(dict.fromkeys(attachments.mapped("res_id")))).exists()
+        current = self._pluto_fingerprints(self, records)
+        return attachments.filtered(
+            lambda att: att.res_id in current and att.pludooprint_fingerprint != current[att.res_id])
+
+    def _pluto_refreshable_reports(self):
+        # Only the reports listed in pludooprint.refresh_stale_reports
+        # (comma-separated report names): some stored PDFs, like posted
+        # invoices, must never change.
+        names = {name.strip() for name in self.env["ir.config_parameter"].sudo().get_param(
+            "pludooprint.refresh_stale_reports", "").split(",") if name.strip()}
+        return self.sudo().filtered(lambda report: report.report_name in names and report.attachment)
+
+    def _pluto_refresh_stale_attachments(self, limit: int = 0) -> int:
+        # Re-render the stale PDFs of these reports in one batch per report and
+        # overwrite the stored files in place. Returns the number refreshed.
+        refreshed = 0
+        for report in self._pluto_refreshable_reports():
+            stale = report._pluto_stale_attachments()
+            if limit:
+                stale = stale[:max(limit - refreshed, 0)]
+            if not stale:
+                continue
+            res_ids = list(dict.fromkeys(stale.mapped("res_id")))
+            streams = self.env["ir.actions.report"].with_context(report_pdf_no_attachment=True) \
+                ._render_qweb_pdf_prepare_streams(report, {}, res_ids=res_ids)
+            fingerprints = report._pluto_fingerprints(report, self.env[report.model].browse(res_ids))
+            done = 0
+            for attachment in stale:
+                stream = streams.get(attachment.res_id, {}).get("stream")
+                if stream is None:
+                    continue
+                attachment.write({
+                    "raw": stream.getvalue(),
+                    "pludooprint_fingerprint": fingerprints[attachment.res_id],
+                })
+                done += 1
+            for data_ in streams.values():
+                if data_["stream"]:
+                    data_["stream"].close()
+            _logger.info("PlutoPrint refreshed %s stale attachments of report %s", done, report.report_name)
+            refreshed += done
+        return refreshed
+
+    @api.model
+    def _cron_refresh_stale_attachments(self):
+        ICP = self.env["ir.config_parameter"].sudo()
+        names = [name.strip() for name in ICP.get_param("pludooprint.refresh_stale_reports", "").split(",")
+                 if name.strip()]
+        if not names:
+            return
+        limit = int(ICP.get_param("pludooprint.refresh_stale_batch", 100))
+        for report in self.sudo().search([("report_name", "in", names), ("attachment", "!=", False)]):
+            report._pluto_refresh_stale_attachments(limit)
+            self.env.cr.commit()
 
-        merged = self._merge_streams(per_body_streams)
-        return {False: {"stream": merged, "attachment": None}}
+    def _pluto_images_to_pdf(self, report_ref, attachments) -> List[bytes]:
+        # Content is read here, on the cursor's thread; PIL does the conversion
+        # in a small thread pool and the results are cached by checksum.
+        policy = self._pluto_image_policy(self._get_pluto_render_profile(self._resolve_paperformat(report_ref)))
+        workers = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.prefetch_workers", 8))
+        return images_to_pdf([(att.raw or b"", att.checksum) for att in attachments], policy, workers)
+
+    def _pluto_lean_assets(self) -> bool:
+        return tools.str2bool(self.env["ir.config_parameter"].sudo().get_param("pludooprint.lean_assets", "True"))
+
+    def _pluto_prepare_document(self, html_bytes: bytes, engine_css: str) -> bytes:
+        doc = inject_css(html_bytes, [engine_css])
+        if self._pluto_lean_assets():
+            doc = strip_html_for_print(doc)
+        return doc
+
+    def _map_article_docs(self, full_html: bytes, html_ids: List, res_ids: List[int]) -> Optional[Dict[int, bytes]]:
+        # One document per record. Articles are matched through their
+        # data-oe-id, and a record rendering several articles gets all of them.
+        if set(x for x in html_ids if x) == set(res_ids):
+            grouped = group_html_articles(full_html, html_ids)
+            if grouped is not None:
+                return {rid: doc for rid, doc in grouped.items() if rid}
+        docs = split_html_articles(full_html)
+        if len(docs) == 1 and len(res_ids) == 1:
+            return {res_ids[0]: docs[0]}
+        if len(docs) == len(res_ids):
+            return dict(zip(res_ids, docs))
+        return None
+
+    def _pluto_record_paperformats(self, report_sudo, res_ids: List[int], default) -> Dict[int, models.BaseModel]:
+        # A report without its own paperformat prints each record on the
+        # paperformat of the record's company, as printing from that company
+        # would; the others all use ``default``.
+        field = self.env[report_sudo.model]._fields.get("company_id")
+        if report_sudo.paperformat_id or not field or field.type != "many2one" or field.comodel_name != "res.company":
+            return dict.fromkeys(res_ids, default)
+        return {
+            record.id: record.company_id.paperformat_id or default
+            for record in self.env[report_sudo.model].browse(res_ids)
+        }
 
     def _resolve_paperformat(self, report_ref):
         report = self._get_report(report_ref) if report_ref else self
         return report.get_paperformat()
 
+    def _get_pluto_render_profile(self, paperformat, specific_args: Optional[Dict] = None) -> RenderProfile:
+        landscape = effective_landscape(specific_args, self._context.get("landscape"))
+        if isinstance(paperformat, models.BaseModel) and paperformat.id:
+            return self._get_pluto_render_profile_cached(paperformat.id, paperformat.write_date, landscape)
+        return build_render_profile(paperformat, landscape)
+
+    @tools.ormcache("paperformat_id", "write_date", "landscape")
+    def _get_pluto_render_profile_cached(self, paperformat_id, write_date, landscape) -> RenderProfile:
+        paperformat = self.env["report.paperformat"].browse(paperformat_id)
+        _logger.info(
+            "PlutoPrint render profile built: name=%s format=%s orientation=%s page_width=%s page_height=%s margins(top/right/bottom/left)=%s/%s/%s/%s landscape=%s",
+            paperformat.name,
+            paperformat.format,
+            paperformat.orientation,
+            paperformat.page_width,
+            paperformat.page_height,
+            paperformat.margin_top,
+            paperformat.margin_right,
+            paperformat.margin_bottom,
+            paperformat.margin_left,
+            landscape,
+        )
+        return build_render_profile(paperformat, landscape)
+
     def _merge_streams(self, streams: List[io.BytesIO]) -> io.BytesIO:
+        if len(streams) == 1:
+            streams[0].seek(0)
+            return streams[0]
+
+        with stage("merge"):
+            return self._merge_streams_into_spool(streams)
+
+    def _merge_streams_into_spool(self, streams: List[io.BytesIO]) -> io.BytesIO:
         writer = PdfFileWriter()
+        # pypdf >= 4.3 clones each page into the writer, so an input can be closed
+        # once its pages are in and identical fonts/images deduplicated at the end.
+        clones_pages = hasattr(writer, "compress_identical_objects")
         for s in streams:
             s.seek(0)
             reader = PdfFileReader(s)
             for i in range(reader.numPages):
                 writer.addPage(reader.getPage(i))
-        merged = io.BytesIO()
+            if clones_pages:
+                s.close()
+        if clones_pages:
+            writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+        merged = SpooledPdfStream(max_size=self._pluto_spool_max_size())
         writer.write(merged)
         merged.seek(0)
         for s in streams:
@@ -168,152 +588,532 @@ class IrActionsReportPluto(models.Model):
                 pass
         return merged
 
+    def _pluto_spool_max_size(self) -> int:
+        # PDFs above this size are kept in a temporary file instead of memory.
+        return int(self.env["ir.config_parameter"].sudo().get_param(
+            "pludooprint.spool_max_size_mb", 16)) * 1024 * 1024
+
+    def _pluto_inprocess_assets(self) -> bool:
+        return tools.str2bool(self.env["ir.config_parameter"].sudo().get_param(
+            "pludooprint.inprocess_assets", "True"))
+
     def _build_cookie_header_for_assets(self) -> Optional[str]:
+        # Assets resolved in-process need no session up front; the fetcher asks
+        # for one if a same-host URL still has to go over HTTP.
+        if self._pluto_inprocess_assets():
+            return None
+        return self._pluto_asset_session_cookie()
+
+    def _pluto_asset_session_cookie(self) -> Optional[str]:
+        # Reuse one short-lived session per db/user/company until its TTL runs
+        # out, then delete it from the session store.
         try:
             if request and request.db:
-                temp_session = root.session_store.new()
-                temp_session.update(
-                    {**request.session, 'debug': '', '_trace_disable': True})
-                if temp_session.uid:
-                    temp_session.session_token = security.compute_session_token(
-                        temp_session, self.env)
-                root.session_store.save(temp_session)
+                ttl = int(self.env["ir.config_parameter"].sudo().get_param(
+                    "pludooprint.asset_session_ttl", 300))
+                key = (request.db, request.session.uid, self.env.company.id, tuple(self.env.companies.ids))
+                now = time.time()
+                with _ASSET_SESSIONS_LOCK:
+                    sid, expires_at = _ASSET_SESSIONS.get(key, (None, 0.0))
+                    if sid and expires_at > now:
+                        return f"session_id={sid}"
+                    for expired_key in [k for k, (_s, exp) in _ASSET_SESSIONS.items() if exp <= now]:
+                        expired_sid, _exp = _ASSET_SESSIONS.pop(expired_key)
+                        try:
+                            root.session_store.delete(root.session_store.get(expired_sid))
+                        except Exception:
+                            _logger.debug("Could not delete report asset session.", exc_info=True)
+
+                    temp_session = root.session_store.new()
+                    temp_session.update(
+                        {**request.session, 'debug': '', '_trace_disable': True})
+                    if temp_session.uid:
+                        temp_session.session_token = security.compute_session_token(
+                            temp_session, self.env)
+                    root.session_store.save(temp_session)
+                    _ASSET_SESSIONS[key] = (temp_session.sid, now + ttl)
                 return f"session_id={temp_session.sid}"
         except Exception:
             _logger.exception(
                 "Failed to create temporary session cookie for report assets.")
         return None
 
-    def _render_with_plutoprint(self, html_bytes: bytes, cookie_header: Optional[str], paperformat=None) -> bytes:
-        if not HAS_PLUTOPRINT:
-            raise UserError(_("PlutoPrint is not available."))
+    def _pluto_image_policy(self, profile: RenderProfile) -> Optional[ImagePolicy]:
+        # Off unless pludooprint.image_max_dpi is set. Images are capped to what
+        # the printable width of the page holds at that resolution.
+        ICP = self.env["ir.config_parameter"].sudo()
+        dpi = int(ICP.get_param("pludooprint.image_max_dpi", 0))
+        if dpi <= 0:
+            return None
+        return ImagePolicy.for_page(
+            max(profile.width - profile.margin_left - profile.margin_right, 72.0),
+            dpi,
+            quality=int(ICP.get_param("pludooprint.image_jpeg_quality", 85)),
+            webp_as_jpg=bool(self.env.context.get("webp_as_jpg")),
+        )
 
-        import plutoprint
+    def _pluto_render_budget(self) -> RenderBudget:
+        # Limits for one document. Inside a chunked render the time and page
+        # limits are what the earlier chunks left (see
+        # _render_chunked_with_plutoprint).
+        ICP = self.env["ir.config_parameter"].sudo()
+        seconds = float(ICP.get_param("pludooprint.max_render_seconds", 0))
+        deadline = self.env.context.get("pludooprint_render_deadline")
+        if seconds > 0 and deadline:
+            seconds = deadline - time.monotonic()
+            if seconds <= 0:
+                raise self._pluto_timeout_error()
+        return RenderBudget(
+            seconds=seconds,
+            pages=self.env.context.get("pludooprint_render_pages") or int(ICP.get_param("pludooprint.max_pages", 0)),
+            fetch_bytes=int(float(ICP.get_param("pludooprint.max_fetch_mb", 0)) * 1024 * 1024),
+        )
+
+    def _pluto_timeout_error(self) -> UserError:
+        return UserError(_("PlutoPrint rendering timed out after %s seconds.", float(
+            self.env["ir.config_parameter"].sudo().get_param("pludooprint.max_render_seconds", 0))))
 
-        base_url = self.env["ir.config_parameter"].sudo().get_param(
-            "web.base.url") or "http://localhost"
+    def _pluto_crash_error(self) -> UserError:
+        return UserError(_(
+            "PlutoPrint stopped unexpectedly while rendering this report, for instance because it ran out of "
+            "memory. Try printing fewer records at once."))
+
+    def _pluto_resource_fetcher(self, cookie_header: Optional[str], image_policy: Optional[ImagePolicy] = None,
+                                max_bytes: int = 0):
+        ICP = self.env["ir.config_parameter"].sudo()
+        base_url = ICP.get_param("web.base.url") or "http://localhost"
+        self._configure_asset_cache()
+        dbname = self.env.cr.dbname
+        uid = self.env.uid
+        local_env = self.env if self._pluto_inprocess_assets() else None
+        local_hosts = {
+            urllib.parse.urlparse(u).netloc
+            for u in (base_url, ICP.get_param("report.url")) if u
+        }
+        session = get_http_session(
+            pool_size=int(ICP.get_param("pludooprint.http_pool_size", 10)),
+            retries=int(ICP.get_param("pludooprint.http_retries", 2)),
+        )
+        timeout = float(ICP.get_param("pludooprint.http_timeout", 6))
+        prefetch_workers = int(ICP.get_param("pludooprint.prefetch_workers", 8))
+        lean_assets = self._pluto_lean_assets()
+        if tools.str2bool(ICP.get_param("pludooprint.font_preload", "True")):
+            FONT_REGISTRY.preload(self.sudo().env)
+        asset_session_cookie = self._pluto_asset_session_cookie
 
         class OdooResourceFetcher(plutoprint.ResourceFetcher):
-            def __init__(self, base_url: str, cookie_header: Optional[str], timeout: int = 6):
+            def __init__(self, base_url: str, cookie_header: Optional[str], timeout: float = 6):
                 self.base_url = base_url.rstrip("/")
                 self.cookie_header = cookie_header
                 self.timeout = timeout
-                self._cache: Dict[str, "plutoprint.ResourceData"] = {}
+                self.prefetch_workers = prefetch_workers
+                self.image_policy = image_policy
+                self.max_bytes = max_bytes
+                self.served_bytes = 0
+                self.over_budget = False
+                self._cache: Dict[str, CachedResource] = {}
+                self._session_requested = cookie_header is not None
 
-            def fetch_url(self, url: str) -> "plutoprint.ResourceData":
-                if not (url.startswith("http://") or url.startswith("https://") or url.startswith("data:")):
-                    url = urllib.parse.urljoin(
-                        self.base_url + "/", url.lstrip("/"))
+            def _cookie(self) -> Optional[str]:
+                # In-process mode starts without a session: create it the first
+                # time a local route that resolve_local_asset does not serve
+                # has to be fetched over HTTP, so it still sees the user.
+                if not self._session_requested and local_env is not None:
+                    self._session_requested = True
+                    self.cookie_header = asset_session_cookie()
+                return self.cookie_header
+
+            def _headers(self, url: str) -> Dict[str, str]:
+                headers = {}
+                base_host = urllib.parse.urlparse(self.base_url).netloc
+                url_host = urllib.parse.urlparse(url).netloc
+                if base_host == url_host or url_host in local_hosts:
+                    cookie = self._cookie()
+                elif "/web/content/" in url:
+                    cookie = self.cookie_header
+                else:
+                    cookie = None
+                if cookie:
+                    headers["Cookie"] = cookie
+                return headers
+
+            def _is_local(self, url: str) -> bool:
+                return local_env is not None and urllib.parse.urlparse(url).netloc in local_hosts
+
+            def _font_key(self, url: str) -> Optional[str]:
+                return font_key(url) if urllib.parse.urlparse(url).netloc in local_hosts else None
+
+            def prefetch(self, urls: List[str]) -> None:
+                # Fetch every remote resource of the document concurrently before the
+                # engine asks for them one at a time; stylesheets get a second pass
+                # for the fonts and images they reference.
+                pending = [absolute_url(self.base_url, u) for u in urls]
+                for _round in range(2):
+                    jobs = []
+                    for url in dict.fromkeys(pending):
+                        if url.startswith("data:") or url in self._cache or self._is_local(url):
+                            continue
+                        fkey = self._font_key(url)
+                        if fkey and FONT_REGISTRY.get(fkey) is not None:
+                            continue
+                        low = url.lower()
+                        if low.endswith(".eot") or "fonts.odoocdn.com" in low:
+                            continue
+                        key = asset_cache_key(dbname, uid, url)
+                        entry = ASSET_CACHE.get(key)
+                        if entry is not None and entry.is_fresh():
+                            continue
+                        jobs.append((url, key, self._headers(url), entry))
+                    results = fetch_remote_many(session, jobs, self.timeout, self.prefetch_workers)
+                    pending = []
+                    for url, entry in results.items():
+                        self._cache[url] = entry
+                        if entry.mime_type == "text/css":
+                            pending.extend(
+                                urllib.parse.urljoin(url, ref)
+                                for ref in extract_resource_urls(entry.content, css_only=True))
+                    if not pending:
+                        break
+
+            def collect(self, urls: List[str]) -> Dict[str, CachedResource]:
+                # Resolve a document's resources, and those of its stylesheets, up
+                # front so they can be handed to a process without a cursor.
+                self.prefetch(urls)
+                resources: Dict[str, CachedResource] = {}
+                pending = [absolute_url(self.base_url, u) for u in urls]
+                for _round in range(2):
+                    nested = []
+                    for url in dict.fromkeys(pending):
+                        if url.startswith("data:") or url in resources:
+                            continue
+                        entry = resources[url] = self.serve(url)
+                        if entry.mime_type == "text/css":
+                            nested.extend(
+                                urllib.parse.urljoin(url, ref)
+                                for ref in extract_resource_urls(entry.content, css_only=True))
+                    pending = nested
+                return resources
+
+            def resolve(self, url: str) -> CachedResource:
+                url = absolute_url(self.base_url, url)
 
                 cached = self._cache.get(url)
                 if cached is not None:
                     return cached
 
+                start = time.perf_counter()
                 low = url.lower()
                 if low.endswith(".eot") or "fonts.odoocdn.com" in low:
-                    rd = plutoprint.ResourceData(b"", "font/woff2", "")
-                    self._cache[url] = rd
-                    return rd
+                    entry = self._cache[url] = CachedResource(b"", "font/woff2", "")
+                    record_fetch(url, "skipped", time.perf_counter() - start, 0)
+                    return entry
 
+                fkey = self._font_key(url)
+                if fkey:
+                    font = FONT_REGISTRY.get(fkey)
+                    if font is not None:
+                        self._cache[url] = font
+                        record_fetch(url, "font", time.perf_counter() - start, len(font.content))
+                        return font
+
+                key = asset_cache_key(dbname, uid, url)
+                entry = ASSET_CACHE.get(key)
+                if entry is not None and entry.is_fresh():
+                    self._cache[url] = entry
+                    record_fetch(url, "cache", time.perf_counter() - start, len(entry.content))
+                    return entry
+
+                if self._is_local(url):
+                    local = resolve_local_asset(local_env, url, ASSET_CACHE.default_ttl)
+                    if local is not None:
+                        if fkey:
+                            FONT_REGISTRY.put(fkey, local)
+                        elif local.expires_at:
+                            ASSET_CACHE.put(key, local)
+                        self._cache[url] = local
+                        record_fetch(url, "local", time.perf_counter() - start, len(local.content))
+                        return local
+
+                entry = fetch_remote(session, url, key, self._headers(url), self.timeout, stale=entry)
+                if fkey:
+                    FONT_REGISTRY.put(fkey, entry)
+                self._cache[url] = entry
+                return entry
+
+            def optimized(self, url: str, entry: CachedResource) -> CachedResource:
+                # Print-cleaned stylesheets and downsampled images; the asset
+                # cache keeps the originals.
+                if entry.mime_type == "text/css":
+                    if lean_assets:
+                        return lean_stylesheet(entry, asset_cache_key(dbname, uid, absolute_url(self.base_url, url)))
+                    return entry
+                if self.image_policy is None:
+                    return entry
+                return optimize_image(entry, self.image_policy)
+
+            def serve(self, url: str) -> CachedResource:
+                # What the engine gets for url: optimized, and nothing more once
+                # the render has used up its fetch budget.
+                entry = self.optimized(url, self.resolve(url))
+                if self.max_bytes:
+                    self.served_bytes += len(entry.content)
+                    if self.served_bytes > self.max_bytes:
+                        self.over_budget = True
+                        return CachedResource(b"", entry.mime_type, entry.encoding)
+                return entry
+
+            def fetch_url(self, url: str) -> "plutoprint.ResourceData":
                 if url.startswith("data:"):
-                    rd = super().fetch_url(url)
-                    self._cache[url] = rd
-                    return rd
+                    # Logos and image fields come embedded (image_data_uri).
+                    entry = optimize_data_uri(url, self.image_policy) if self.image_policy else None
+                    if entry is None:
+                        return super().fetch_url(url)
+                    return plutoprint.ResourceData(entry.content, entry.mime_type, entry.encoding)
+                entry = self.serve(url)
+                return plutoprint.ResourceData(entry.content, entry.mime_type, entry.encoding)
 
-                headers = {}
-                if self.cookie_header:
-                    base_host = urllib.parse.urlparse(self.base_url).netloc
-                    url_host = urllib.parse.urlparse(url).netloc
-                    if base_host == url_host or "/web/content/" in url:
-                        headers["Cookie"] = self.cookie_header
-
-                try:
-                    resp = requests.get(
-                        url, headers=headers, timeout=self.timeout, allow_redirects=True)
-                    if resp.status_code == 404:
-                        rd = plutoprint.ResourceData(
-                            b"", "application/octet-stream", "")
-                    else:
-                        resp.raise_for_status()
-                        ctype = resp.headers.get(
-                            "Content-Type", "application/octet-stream").split(";")[0].strip()
-                        enc = resp.encoding or "utf-8" if ctype.startswith(
-                            "text/") or ctype in ("application/xml", "image/svg+xml") else ""
-                        rd = plutoprint.ResourceData(resp.content, ctype, enc)
-                except Exception:
-                    rd = plutoprint.ResourceData(
-                        b"", "application/octet-stream", "")
-
-                self._cache[url] = rd
-                return rd
-
-        page_size = plutoprint.PAGE_SIZE_A4
-        if paperformat:
-            format_key = (paperformat.format or "").upper()
-            _logger.info(
-                "PlutoPrint paperformat received: name=%s format=%s orientation=%s page_width=%s page_height=%s margins(top/right/bottom/left)=%s/%s/%s/%s",
-                getattr(paperformat, "name", None),
-                getattr(paperformat, "format", None),
-                getattr(paperformat, "orientation", None),
-                getattr(paperformat, "page_width", None),
-                getattr(paperformat, "page_height", None),
-                getattr(paperformat, "margin_top", None),
-                getattr(paperformat, "margin_right", None),
-                getattr(paperformat, "margin_bottom", None),
-                getattr(paperformat, "margin_left", None),
+        return OdooResourceFetcher(base_url, cookie_header, timeout=timeout)
+
+    def _render_with_plutoprint(self, html_bytes: bytes, cookie_header: Optional[str], paperformat=None) -> BinaryIO:
+        # The PDF is written once, into a spooled stream that goes as is into
+        # collected_streams; cache hits come back as a BytesIO.
+        if not HAS_PLUTOPRINT:
+            raise UserError(_("PlutoPrint is not available."))
+
+        profile = self._get_pluto_render_profile(paperformat)
+        image_policy = self._pluto_image_policy(profile)
+        pdf_cache = self._get_pluto_pdf_cache()
+        cache_key = pdf_cache.make_key(html_bytes, profile, image_policy) if pdf_cache else None
+        if cache_key:
+            pdf = pdf_cache.get(cache_key)
+            if pdf is not None:
+                count("pdf_cache_hits")
+                return io.BytesIO(pdf)
+
+        budget = self._pluto_render_budget()
+        fetcher = self._pluto_resource_fetcher(cookie_header, image_policy, max_bytes=budget.fetch_bytes)
+        if budget.seconds > 0:
+            output = self._render_supervised(html_bytes, profile, fetcher, budget)
+        else:
+            book = self._pluto_load_book(html_bytes, profile, fetcher)
+            try:
+                check_page_budget(book, budget.pages)
+            except RenderBudgetExceeded as e:
+                raise UserError(_("This document is too long to print: %s.", e)) from e
+            with stage("write"):
+                output = write_pdf_to(book, SpooledPdfStream(max_size=self._pluto_spool_max_size()))
+        output.seek(0, io.SEEK_END)
+        size = output.tell()
+        count("documents")
+        count("pdf_bytes", size)
+        if cache_key:
+            output.seek(0)
+            pdf_cache.put_file(cache_key, output, size)
+        output.seek(0)
+        return output
+
+    def _pluto_load_book(self, html_bytes: bytes, profile: RenderProfile, fetcher) -> "plutoprint.Book":
+        if fetcher.prefetch_workers > 0:
+            with stage("prefetch"):
+                fetcher.prefetch(extract_resource_urls(html_bytes))
+
+        book = new_book(profile)
+        book.custom_resource_fetcher = fetcher
+
+        with stage("load"):
+            book.load_data(
+                html_bytes,
+                mime_type="text/html",
+                text_encoding="utf-8",
+                base_url=fetcher.base_url,
             )
-            page_sizes = {
-                "A3": plutoprint.PAGE_SIZE_A3,
-                "A4": plutoprint.PAGE_SIZE_A4,
-                "A5": plutoprint.PAGE_SIZE_A5,
-                "B4": plutoprint.PAGE_SIZE_B4,
-                "B5": plutoprint.PAGE_SIZE_B5,
-                "LETTER": plutoprint.PAGE_SIZE_LETTER,
-                "LEGAL": plutoprint.PAGE_SIZE_LEGAL,
-                "LEDGER": plutoprint.PAGE_SIZE_LEDGER,
-            }
-            if format_key == "CUSTOM" and paperformat.page_width and paperformat.page_height:
-                page_size = plutoprint.PageSize(
-                    paperformat.page_width * plutoprint.UNITS_MM,
-                    paperformat.page_height * plutoprint.UNITS_MM,
+        self._pluto_check_fetch_budget(fetcher)
+        return book
+
+    def _render_supervised(self, html_bytes: bytes, profile: RenderProfile, fetcher, budget: RenderBudget) -> BinaryIO:
+        # Lay the document out in a child process that is killed once it runs
+        # over budget.seconds; an engine stuck in native code cannot be
+        # interrupted from a thread. Collecting the resources counts too.
+        deadline = time.monotonic() + budget.seconds
+        with stage("collect"):
+            resources = fetcher.collect(extract_resource_urls(html_bytes))
+        self._pluto_check_fetch_budget(fetcher)
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise self._pluto_timeout_error()
+        try:
+            with stage("pool"):
+                pdf = render_in_pool(
+                    [html_bytes], profile, fetcher.base_url, resources, workers=1, timeout=timeout,
+                    start_method=self.env["ir.config_parameter"].sudo().get_param(
+                        "pludooprint.parallel_start_method", "fork"),
+                    max_pages=budget.pages,
+                    image_policy=fetcher.image_policy,
+                )[0]
+        except FutureTimeoutError:
+            raise self._pluto_timeout_error()
+        except RenderBudgetExceeded as e:
+            raise UserError(_("This document is too long to print: %s.", e)) from e
+        except BrokenProcessPool as e:
+            raise self._pluto_crash_error() from e
+        return io.BytesIO(pdf)
+
+    def _pluto_check_fetch_budget(self, fetcher) -> None:
+        if fetcher.over_budget:
+            raise UserError(_(
+                "This document references more than %s MB of images and other resources.",
+                round(fetcher.max_bytes / (1024 * 1024), 1)))
+
+    def _render_many_with_plutoprint(self, docs: List[bytes], cookie_header: Optional[str], paperformat=None,
+                                     paperformats: Optional[List] = None) -> List[BinaryIO]:
+        # Opt-in: with pludooprint.parallel_workers >= 2 the documents are laid out
+        # by a pool of processes, fed with resources resolved here beforehand.
+        # ``paperformats`` gives one paperformat per document for mixed batches;
+        # they all share the pool.
+        ICP = self.env["ir.config_parameter"].sudo()
+        workers = int(ICP.get_param("pludooprint.parallel_workers", 0))
+        paperformats = paperformats or [paperformat] * len(docs)
+        if workers < 2 or len(docs) < 2:
+            return [self._render_with_plutoprint(doc, cookie_header, paperformat=doc_paperformat)
+                    for doc, doc_paperformat in zip(docs, paperformats)]
+        if not HAS_PLUTOPRINT:
+            raise UserError(_("PlutoPrint is not available."))
+
+        budget = self._pluto_render_budget()
+        timeout = float(ICP.get_param("pludooprint.parallel_timeout", 120))
+        if budget.seconds > 0:
+            timeout = min(timeout, budget.seconds)
+        profile_by_format = {pf: self._get_pluto_render_profile(pf) for pf in set(paperformats)}
+        profiles = [profile_by_format[pf] for pf in paperformats]
+        # Images are sized for the widest page of the batch.
+        image_policy = max(
+            filter(None, map(self._pluto_image_policy, profile_by_format.values())),
+            key=lambda policy: policy.max_px, default=None)
+        pdf_cache = self._get_pluto_pdf_cache()
+        cache_keys = [pdf_cache.make_key(doc, profile, image_policy)
+                      for doc, profile in zip(docs, profiles)] if pdf_cache else []
+        pdfs = [pdf_cache.get(key) for key in cache_keys] if pdf_cache else [None] * len(docs)
+        missing = [i for i, pdf in enumerate(pdfs) if pdf is None]
+        count("pdf_cache_hits", len(docs) - len(missing))
+        if not missing:
+            return [io.BytesIO(pdf) for pdf in pdfs]
+
+        fetcher = self._pluto_resource_fetcher(cookie_header, image_policy, max_bytes=budget.fetch_bytes)
+        with stage("collect"):
+            urls = list(dict.fromkeys(url for i in missing for url in extract_resource_urls(docs[i])))
+            resources = fetcher.collect(urls)
+        self._pluto_check_fetch_budget(fetcher)
+        try:
+            with stage("pool"):
+                rendered = render_in_pool(
+                    [docs[i] for i in missing], [profiles[i] for i in missing], fetcher.base_url, resources,
+                    workers=workers, timeout=timeout,
+                    start_method=ICP.get_param("pludooprint.parallel_start_method", "fork"),
+                    max_pages=budget.pages,
+                    image_policy=image_policy,
                 )
-            else:
-                page_size = page_sizes.get(format_key, page_size)
-
-            if paperformat.orientation == "Landscape":
-                page_size = page_size.landscape()
-            else:
-                page_size = page_size.portrait()
-
-            margins = plutoprint.PageMargins(
-                top=paperformat.margin_top * plutoprint.UNITS_MM,
-                right=paperformat.margin_right * plutoprint.UNITS_MM,
-                bottom=paperformat.margin_bottom * plutoprint.UNITS_MM,
-                left=paperformat.margin_left * plutoprint.UNITS_MM,
-            )
-        else:
-            margins = plutoprint.PAGE_MARGINS_NONE
+        except FutureTimeoutError:
+            raise UserError(_("PlutoPrint rendering timed out after %s seconds.", timeout))
+        except RenderBudgetExceeded as e:
+            raise UserError(_("This document is too long to print: %s.", e)) from e
+        except BrokenProcessPool as e:
+            raise self._pluto_crash_error() from e
+        for i, pdf in zip(missing, rendered):
+            count("documents")
+            count("pdf_bytes", len(pdf))
+            pdfs[i] = pdf
+            if pdf_cache:
+                pdf_cache.put(cache_keys[i], pdf)
+        return [io.BytesIO(pdf) for pdf in pdfs]
 
-        book = plutoprint.Book(
-            page_size,
-            margins,
-            media=plutoprint.MEDIA_TYPE_PRINT
+    def _get_pluto_pdf_cache(self) -> Optional[PdfResultCache]:
+        # Off unless pludooprint.pdf_cache_size_mb is set; lives in the filestore.
+        max_mb = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.pdf_cache_size_mb", 0))
+        if max_mb <= 0 or self.env.context.get("pludooprint_no_pdf_cache"):
+            return None
+        directory = os.path.join(tools.config.filestore(self.env.cr.dbname), "pludooprint_pdf")
+        return get_pdf_cache(directory, max_mb * 1024 * 1024)
+
+    def _configure_asset_cache(self):
+        ICP = self.env["ir.config_parameter"].sudo()
+        ASSET_CACHE.configure(
+            max_bytes=int(ICP.get_param("pludooprint.asset_cache_size_mb", 64)) * 1024 * 1024,
+            directory=ICP.get_param("pludooprint.asset_cache_dir") or None,
+            default_ttl=int(ICP.get_param("pludooprint.asset_cache_default_ttl", 300)),
         )
-        book.custom_resource_fetcher = OdooResourceFetcher(
-            base_url, cookie_header)
-
-        book.load_data(
-            html_bytes,
-            mime_type="text/html",
-            text_encoding="utf-8",
-            base_url=base_url,
+
+    def _pluto_report_stats(self, report_sudo, stats: RenderStats, res_ids=None):
+        summary = stats.summary()
+        summary["records"] = len(res_ids or [])
+        _logger.info(
+            "PlutoPrint render %s", " ".join(f"{k}={v}" for k, v in summary.items()),
+            extra={"pludooprint_stats": summary},
         )
+        if _logger.isEnabledFor(logging.DEBUG):
+            for fetch in stats.fetches:
+                _logger.debug("PlutoPrint fetch status=%s ms=%.2f bytes=%s url=%s",
+                              fetch.status, fetch.seconds * 1000, fetch.size, fetch.url)
+        # Opt-in: a row per render is a write in the caller's transaction, on
+        # what is otherwise a read (portal downloads, mail attachments).
+        if tools.str2bool(self.env["ir.config_parameter"].sudo().get_param("pludooprint.collect_stats", "False")):
+            self.env["pludooprint.report.stat"].sudo()._record(report_sudo, stats, len(res_ids or []))
+
+    @api.model
+    def get_plutoprint_asset_cache_stats(self):
+        return ASSET_CACHE.stats()
+
+    @api.model
+    def get_plutoprint_font_registry_stats(self):
+        return FONT_REGISTRY.stats()
+
+    @api.model
+    def get_plutoprint_pdf_cache_stats(self):
+        pdf_cache = self._get_pluto_pdf_cache()
+        return pdf_cache.stats() if pdf_cache else {}
+
+    @api.model
+    def get_plutoprint_preview(self, report_ref, res_id: int, pages: int = 1, dpi: float = 72) -> List[str]:
+        # _pluto_preview_png() for the web client, base64-encoded.
+        return [base64.b64encode(image).decode() for image in self._pluto_preview_png(report_ref, res_id, pages, dpi)]
+
+    def _pluto_preview_png(self, report_ref, res_id: int, pages: int = 1, dpi: float = 72) -> List[bytes]:
+        # PNG images of the first ``pages`` pages of one record's report: the
+        # document is laid out once and only those pages are painted, no PDF
+        # involved. Page setup is the PDF's (record paperformat, landscape).
+        # Cached until the record's write_date or its paperformat changes.
+        if not HAS_PLUTOPRINT:
+            raise UserError(_("PlutoPrint is not available."))
+        report_sudo = self._get_report(report_ref)
+        record = self.env[report_sudo.model].browse(res_id)
+        record.check_access("read")
+        paperformat = self._pluto_record_paperformats(
+            report_sudo, [res_id], self._resolve_paperformat(report_sudo))[res_id]
+        key = "|".join(str(part) for part in (
+            self.env.cr.dbname, report_sudo.id, res_id, record.write_date, self.env.uid,
+            self.env.lang, self.env.company.id, paperformat.id, paperformat.write_date,
+            self.env.context.get("landscape"), pages, dpi))
+        images = PREVIEW_CACHE.get(key)
+        if images is not None:
+            return images
 
-        output = io.BytesIO()
-        book.write_to_pdf_stream(output)
-        pdf = output.getvalue()
-        output.close()
-        return pdf
+        with track_render(report_sudo.report_name):
+            with stage("qweb"):
+                html = self.with_context(debug=False)._render_qweb_html(
+                    report_sudo, [res_id], data={"report_type": "pdf"})[0]
+            with stage("prepare_html"):
+                specific = self.with_context(debug=False)._prepare_html(html, report_model=report_sudo.model)[4]
+            articles = split_html_articles(html)
+            profile = self._get_pluto_render_profile(paperformat)
+            doc = self._pluto_prepare_document(
+                articles[0] if articles else html, self._get_pluto_render_profile(paperformat, specific).engine_css)
+            fetcher = self._pluto_resource_fetcher(
+                self._build_cookie_header_for_assets(), self._pluto_image_policy(profile),
+                max_bytes=self._pluto_render_budget().fetch_bytes)
+            book = self._pluto_load_book(doc, profile, fetcher)
+            with stage("write"):
+                images = write_png_pages(book, max(1, pages), dpi)
+        PREVIEW_CACHE.put(key, images, sum(len(image) for image in images))
+        return images
 
     @api.model
     def get_wkhtmltopdf_state(self):
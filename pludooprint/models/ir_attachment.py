@@ -0,0 +1,9 @@
+from odoo import fields, models
+
+
+class IrAttachment(models.Model):
+    _inherit = "ir.attachment"
+
+    # "<report id>:<sha1>" of the inputs a stored report PDF was rendered from;
+    # see ir.actions.report._pluto_fingerprints().
+    pludooprint_fingerprint = fields.Char(copy=False, index="btree_not_null")
@@ -0,0 +1,13 @@
+from odoo import models
+
+
+class IrHttp(models.AbstractModel):
+    _inherit = "ir.http"
+
+    def session_info(self):
+        # static/src/report_queue.js only asks the server whether to queue a
+        # report when queueing is enabled and the batch is large enough.
+        result = super().session_info()
+        result["pludooprint_queue_threshold"] = int(
+            self.env["ir.config_parameter"].sudo().get_param("pludooprint.queue_threshold", 0))
+        return result
@@ -0,0 +1,130 @@
+import logging
+import threading
+from datetime import timedelta
+
+from odoo import SUPERUSER_ID, _, api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class PludooprintReportJob(models.Model):
+    _name = "pludooprint.report.job"
+    _description = "PlutoPrint Queued Report"
+    _order = "id desc"
+
+    name = fields.Char(required=True)
+    report_id = fields.Many2one("ir.actions.report", string="Report", required=True, ondelete="cascade")
+    res_ids = fields.Json()
+    data = fields.Json()
+    user_id = fields.Many2one("res.users", string="User", required=True, index=True, default=lambda self: self.env.uid)
+    company_id = fields.Many2one("res.company", string="Company", required=True, default=lambda self: self.env.company)
+    state = fields.Selection([
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ], default="pending", required=True, index=True)
+    attachment_id = fields.Many2one("ir.attachment", string="Result", ondelete="set null")
+    error = fields.Text()
+    date_started = fields.Datetime()
+    date_done = fields.Datetime()
+
+    @api.model
+    def _enqueue(self, report, res_ids, data=None):
+        job = self.sudo().create({
+            "name": _("%(report)s (%(count)s records)", report=report.name, count=len(res_ids)),
+            "report_id": report.id,
+            "res_ids": list(res_ids),
+            "data": data or {},
+            "user_id": self.env.uid,
+            "company_id": self.env.company.id,
+        })
+        self.env.ref("pludooprint.ir_cron_report_jobs").sudo()._trigger()
+        return job
+
+    @api.model
+    def _cron_process_jobs(self):
+        ICP = self.env["ir.config_parameter"].sudo()
+        concurrency = int(ICP.get_param("pludooprint.queue_concurrency", 1))
+        limit = int(ICP.get_param("pludooprint.queue_jobs_per_run", 10))
+        if concurrency <= 1:
+            self._process_jobs(limit)
+            return
+        threads = [
+            threading.Thread(target=self._process_jobs_in_thread, args=(limit,),
+                             name=f"pludooprint-queue-{i}", daemon=True)
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _process_jobs_in_thread(self, limit):
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env[self._name]._process_jobs(limit)
+
+    def _process_jobs(self, limit):
+        for _i in range(limit):
+            # The row lock is held until the commit, so concurrent runners skip it.
+            self.env.cr.execute("""
+                SELECT id FROM pludooprint_report_job
+                 WHERE state = 'pending'
+              ORDER BY id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+            """)
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            self.browse(row[0])._run()
+            self.env.cr.commit()
+
+    def _run(self):
+        self.ensure_one()
+        self.write({"state": "running", "date_started": fields.Datetime.now()})
+        # Rendered as the requester would see it printed: their rights,
+        # company, language and timezone.
+        report = self.report_id.with_user(self.user_id).with_company(self.company_id).with_context(
+            pludooprint_in_queue=True, allowed_company_ids=self.company_id.ids,
+            lang=self.user_id.lang, tz=self.user_id.tz)
+        try:
+            with self.env.cr.savepoint():
+                pdf_content, _report_type = report._render_qweb_pdf(self.report_id.id, self.res_ids, data=self.data)
+        except Exception as e:
+            _logger.exception("PlutoPrint queued report %s failed", self.id)
+            self.write({"state": "failed", "error": str(e), "date_done": fields.Datetime.now()})
+            self._notify_user(_("Report “%s” failed: %s", self.name, e), "danger")
+            return
+        attachment = self.env["ir.attachment"].create({
+            "name": f"{self.report_id.name}.pdf",
+            "raw": pdf_content,
+            "mimetype": "application/pdf",
+            "res_model": self._name,
+            "res_id": self.id,
+        })
+        self.write({"state": "done", "attachment_id": attachment.id, "date_done": fields.Datetime.now()})
+        self._notify_user(_("Report “%s” is ready.", self.name), "success", attachment)
+
+    def _notify_user(self, message, notification_type, attachment=None):
+        # Shown by static/src/report_queue.js, with a download button when the
+        # PDF is attached.
+        self.env["bus.bus"]._sendone(self.user_id.partner_id, "pludooprint.report_ready", {
+            "title": _("PlutoPrint"),
+            "message": message,
+            "type": notification_type,
+            "attachment_id": attachment.id if attachment else False,
+        })
+
+    @api.autovacuum
+    def _gc_finished_jobs(self):
+        # Finished jobs and their PDFs are kept for
+        # pludooprint.queue_retention_days, long enough to be downloaded.
+        days = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.queue_retention_days", 7))
+        jobs = self.sudo().search([
+            ("state", "in", ("done", "failed")),
+            ("date_done", "<", fields.Datetime.now() - timedelta(days=days)),
+        ])
+        jobs.attachment_id.unlink()
+        jobs.unlink()
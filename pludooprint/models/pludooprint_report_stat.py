@@ -0,0 +1,65 @@
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+
+class PludooprintReportStat(models.Model):
+    _name = "pludooprint.report.stat"
+    _description = "PlutoPrint Report Render Statistics"
+    _order = "create_date desc, id desc"
+
+    report_id = fields.Many2one("ir.actions.report", string="Report", index=True, ondelete="cascade")
+    report_name = fields.Char(index=True)
+    user_id = fields.Many2one("res.users", string="User", default=lambda self: self.env.uid)
+    record_count = fields.Integer()
+    document_count = fields.Integer()
+    total_ms = fields.Float(string="Total (ms)", aggregator="avg")
+    attachments_ms = fields.Float(string="Stored Attachments (ms)", aggregator="avg")
+    qweb_ms = fields.Float(string="QWeb (ms)", aggregator="avg")
+    prepare_html_ms = fields.Float(string="Prepare HTML (ms)", aggregator="avg")
+    split_ms = fields.Float(string="Split (ms)", aggregator="avg")
+    prefetch_ms = fields.Float(string="Prefetch (ms)", aggregator="avg")
+    collect_ms = fields.Float(string="Collect Resources (ms)", aggregator="avg")
+    fetch_ms = fields.Float(string="Asset Fetch (ms)", aggregator="avg")
+    load_ms = fields.Float(string="Load Data (ms)", aggregator="avg")
+    write_ms = fields.Float(string="Write PDF (ms)", aggregator="avg")
+    pool_ms = fields.Float(string="Process Pool (ms)", aggregator="avg")
+    merge_ms = fields.Float(string="Merge (ms)", aggregator="avg")
+    html_bytes = fields.Integer()
+    pdf_bytes = fields.Integer()
+    fetch_count = fields.Integer()
+    fetch_cache_hits = fields.Integer()
+    fetch_bytes = fields.Integer()
+    pdf_cache_hits = fields.Integer()
+    slowest_url = fields.Char()
+    slowest_url_ms = fields.Float(string="Slowest URL (ms)")
+
+    @api.model
+    def _record(self, report, stats, record_count):
+        summary = stats.summary()
+        slowest = stats.slowest_fetch()
+        statuses = summary.get("fetch_status", {})
+        vals = {
+            "report_id": report.id,
+            "report_name": stats.report_name,
+            "record_count": record_count,
+            "document_count": summary.get("documents", 0),
+            "html_bytes": summary.get("html_bytes", 0),
+            "pdf_bytes": summary.get("pdf_bytes", 0),
+            "fetch_count": summary.get("fetch_count", 0),
+            "fetch_cache_hits": statuses.get("cache", 0) + statuses.get("revalidated", 0) + statuses.get("font", 0),
+            "fetch_bytes": summary.get("fetch_bytes", 0),
+            "pdf_cache_hits": summary.get("pdf_cache_hits", 0),
+            "slowest_url": slowest.url if slowest else False,
+            "slowest_url_ms": slowest.seconds * 1000 if slowest else 0.0,
+        }
+        for name in ("total", "attachments", "qweb", "prepare_html", "split", "prefetch", "collect", "fetch", "load",
+                     "write", "pool", "merge"):
+            vals[f"{name}_ms"] = summary.get(f"{name}_ms", 0.0)
+        return self.create(vals)
+
+    @api.autovacuum
+    def _gc_render_stats(self):
+        days = int(self.env["ir.config_parameter"].sudo().get_param("pludooprint.stats_retention_days", 30))
+        limit_date = fields.Datetime.now() - timedelta(days=days)
+        self.search([("create_date", "<", limit_date)]).unlink()
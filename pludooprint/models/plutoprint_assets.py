@@ -0,0 +1,254 @@
+import contextvars
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from odoo.exceptions import AccessError, MissingError
+from odoo.tools.misc import file_path
+
+from .plutoprint_cache import ASSET_CACHE, CachedResource, LRUCache, cache_expiry
+from .plutoprint_helpers import clean_print_css
+from .plutoprint_metrics import record_fetch
+
+_logger = logging.getLogger(__name__)
+
+BUNDLE_TTL = 365 * 24 * 3600
+
+_STATIC_PATH_RE = re.compile(r"^/([^/]+)/static/")
+_BINARY_PATH_RE = re.compile(r"^/web/(content|image)(?:/(.*))?$")
+_BARCODE_PATH_RE = re.compile(r"^/report/barcode(?:/([^/]+)/(.+?))?/?$")
+_SIZE_RE = re.compile(r"^(\d+)x(\d+)$")
+_ATTACHMENT_ID_RE = re.compile(r"^(\d+)(?:-[^/]+)?$")
+_TEXT_TYPES = ("application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+EMPTY_RESOURCE = CachedResource(b"", "application/octet-stream", "")
+
+# Print-cleaned stylesheets, by asset cache key for bundles (name and version)
+# and by content hash otherwise.
+LEAN_CSS_CACHE = LRUCache(16 * 1024 * 1024)
+
+_http_lock = threading.Lock()
+_http_session: Optional[requests.Session] = None
+_http_session_key: Optional[Tuple[int, int, int]] = None
+
+
+def _encoding_for(mimetype: str) -> str:
+    return "utf-8" if mimetype.startswith("text/") or mimetype in _TEXT_TYPES else ""
+
+
+def resolve_local_asset(env, url: str, default_ttl: int = 300) -> Optional[CachedResource]:
+    # Serve the URLs a report usually references straight from the database and
+    # the addons path, so rendering never goes back through the HTTP workers.
+    # None means the URL is not ours to resolve and should be fetched over HTTP.
+    parsed = urllib.parse.urlsplit(url)
+    path = urllib.parse.unquote(parsed.path)
+    if path.startswith("/web/assets/"):
+        return _resolve_bundle(env, path)
+    if _STATIC_PATH_RE.match(path):
+        return _resolve_static(path, default_ttl)
+    match = _BINARY_PATH_RE.match(path)
+    if match:
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        return _resolve_binary(env, match.group(1), match.group(2) or "", query)
+    match = _BARCODE_PATH_RE.match(path)
+    if match:
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        return _resolve_barcode(env, match.group(1), match.group(2), query)
+    return None
+
+
+def _resolve_barcode(env, barcode_type: Optional[str], value: Optional[str],
+                     query: Dict[str, str]) -> CachedResource:
+    # What the /report/barcode route returns. Barcodes only depend on the URL,
+    # so they are cached as long as bundles.
+    barcode_type = barcode_type or query.pop("barcode_type", None) or query.pop("type", None)
+    value = value if value is not None else query.pop("value", None)
+    try:
+        content = env["ir.actions.report"].barcode(barcode_type, value, **query)
+    except (ValueError, AttributeError, TypeError):
+        _logger.debug("PlutoPrint could not render barcode %s %r", barcode_type, value, exc_info=True)
+        return EMPTY_RESOURCE
+    return CachedResource(content, "image/png", "", "", time.time() + BUNDLE_TTL)
+
+
+def _resolve_bundle(env, path: str) -> Optional[CachedResource]:
+    attachment = env["ir.attachment"].sudo().search([
+        ("url", "=", path),
+        ("public", "=", True),
+        ("res_model", "=", "ir.ui.view"),
+    ], limit=1)
+    if not attachment:
+        attachment = _generate_bundle(env, path.rsplit("/", 1)[-1])
+    if not attachment:
+        return None
+    mimetype = attachment.mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return CachedResource(attachment.raw or b"", mimetype, _encoding_for(mimetype), "", time.time() + BUNDLE_TTL)
+
+
+def _generate_bundle(env, filename: str):
+    # Bundles are only saved as attachments the first time /web/assets serves
+    # them; build the attachment here like the controller would.
+    try:
+        bundle_name, rtl, asset_type, autoprefix = env["ir.asset"]._parse_bundle_name(filename, False)
+        bundle = env["ir.qweb"]._get_asset_bundle(
+            bundle_name, css=asset_type == "css", js=asset_type == "js",
+            rtl=rtl, autoprefix=autoprefix)
+        if asset_type == "css" and bundle.stylesheets:
+            return env["ir.attachment"].sudo().browse(bundle.css().id)
+        if asset_type == "js" and bundle.javascripts:
+            return env["ir.attachment"].sudo().browse(bundle.js().id)
+    except Exception:
+        _logger.debug("PlutoPrint could not build asset bundle %s", filename, exc_info=True)
+    return None
+
+
+def _resolve_static(path: str, default_ttl: int) -> Optional[CachedResource]:
+    normalized = os.path.normpath(path)
+    match = _STATIC_PATH_RE.match(normalized)
+    if not match:
+        return None
+    try:
+        full_path = file_path(normalized.lstrip("/"))
+        with open(full_path, "rb") as fh:
+            content = fh.read()
+    except (OSError, ValueError):
+        return None
+    mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    return CachedResource(content, mimetype, _encoding_for(mimetype), "", time.time() + default_ttl)
+
+
+def _resolve_binary(env, kind: str, rest: str, query: Dict[str, str]) -> Optional[CachedResource]:
+    segments: List[str] = [s for s in rest.split("/") if s]
+    width = height = 0
+    if segments and _SIZE_RE.match(segments[-1]) and kind == "image":
+        width, height = (int(x) for x in _SIZE_RE.match(segments[-1]).groups())
+        segments = segments[:-1]
+
+    find_kwargs = {"access_token": query.get("access_token")}
+    field = query.get("field") or "raw"
+    if not segments:
+        if not (query.get("model") and query.get("id", "").isdigit()):
+            return None
+        find_kwargs.update(res_model=query["model"], res_id=int(query["id"]))
+    elif _ATTACHMENT_ID_RE.match(segments[0]):
+        find_kwargs.update(res_id=int(_ATTACHMENT_ID_RE.match(segments[0]).group(1)))
+    elif len(segments) >= 3 and segments[1].isdigit():
+        find_kwargs.update(res_model=segments[0], res_id=int(segments[1]))
+        field = segments[2]
+    elif len(segments) <= 2 and "." in segments[0]:
+        find_kwargs.update(xmlid=segments[0])
+    else:
+        return None
+
+    ir_binary = env["ir.binary"]
+    try:
+        record = ir_binary._find_record(**find_kwargs)
+        if kind == "image":
+            stream = ir_binary._get_image_stream_from(record, field, width=width, height=height)
+        else:
+            stream = ir_binary._get_stream_from(record, field)
+        content = stream.read()
+    except (AccessError, MissingError, ValueError):
+        return EMPTY_RESOURCE
+    except Exception:
+        _logger.debug("PlutoPrint could not resolve /web/%s/%s in-process", kind, rest, exc_info=True)
+        return None
+    mimetype = stream.mimetype or "application/octet-stream"
+    return CachedResource(content, mimetype, _encoding_for(mimetype))
+
+
+def lean_stylesheet(entry: CachedResource, key: str) -> CachedResource:
+    if entry.mime_type != "text/css" or not entry.content:
+        return entry
+    if "|bundle|" not in key:
+        key = hashlib.sha1(entry.content).hexdigest()
+    content = LEAN_CSS_CACHE.get(key)
+    if content is None:
+        content = clean_print_css(entry.content)
+        LEAN_CSS_CACHE.put(key, content, len(content))
+    return entry._replace(content=content, encoding="utf-8")
+
+
+def get_http_session(pool_size: int = 10, retries: int = 2) -> requests.Session:
+    # One keep-alive session per worker process; rebuilt after a fork or when
+    # the pool settings change.
+    global _http_session, _http_session_key
+    key = (os.getpid(), pool_size, retries)
+    with _http_lock:
+        if _http_session is None or _http_session_key != key:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=Retry(
+                    total=retries,
+                    backoff_factor=0.2,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=("GET", "HEAD"),
+                    raise_on_status=False,
+                ),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session, _http_session_key = session, key
+        return _http_session
+
+
+def fetch_remote(session: requests.Session, url: str, key: str, headers: Dict[str, str],
+                 timeout: float, stale: Optional[CachedResource] = None) -> CachedResource:
+    headers = dict(headers)
+    if stale is not None and stale.etag:
+        headers["If-None-Match"] = stale.etag
+    start = time.perf_counter()
+    try:
+        resp = session.get(url, headers=headers, timeout=timeout, allow_redirects=True)
+        if resp.status_code == 304 and stale is not None:
+            expires_at = cache_expiry(resp.headers, ASSET_CACHE.default_ttl)
+            entry = ASSET_CACHE.revalidate(key, stale, expires_at or 0.0)
+            record_fetch(url, "revalidated", time.perf_counter() - start, len(entry.content))
+            return entry
+        if resp.status_code == 404:
+            record_fetch(url, "not_found", time.perf_counter() - start, 0)
+            return EMPTY_RESOURCE
+        resp.raise_for_status()
+        ctype = resp.headers.get(
+            "Content-Type", "application/octet-stream").split(";")[0].strip()
+        enc = resp.encoding or "utf-8" if ctype.startswith(
+            "text/") or ctype in ("application/xml", "image/svg+xml") else ""
+        entry = CachedResource(resp.content, ctype, enc, resp.headers.get("ETag", ""))
+        expires_at = cache_expiry(resp.headers, ASSET_CACHE.default_ttl)
+        if expires_at is not None:
+            entry = entry._replace(expires_at=expires_at)
+            ASSET_CACHE.put(key, entry)
+        record_fetch(url, "remote", time.perf_counter() - start, len(entry.content))
+        return entry
+    except Exception:
+        _logger.debug("PlutoPrint failed to fetch %s", url, exc_info=True)
+        record_fetch(url, "error", time.perf_counter() - start, 0)
+        return EMPTY_RESOURCE
+
+
+def fetch_remote_many(session: requests.Session, jobs: Iterable[Tuple[str, str, Dict[str, str], Optional[CachedResource]]],
+                      timeout: float, max_workers: int) -> Dict[str, CachedResource]:
+    jobs = list(jobs)
+    if not jobs:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs))),
+                            thread_name_prefix="pludooprint-fetch") as pool:
+        futures = {
+            url: pool.submit(contextvars.copy_context().run,
+                             fetch_remote, session, url, key, headers, timeout, stale)
+            for url, key, headers, stale in jobs
+        }
+        return {url: future.result() for url, future in futures.items()}
@@ -0,0 +1,366 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Mapping, NamedTuple, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+_ASSET_URL_RE = re.compile(r"/web/assets/(?:\d+/)?([^/]+)/([^/?#]+)")
+_STATIC_URL_RE = re.compile(r"^/[^/]+/static/")
+
+
+class CachedResource(NamedTuple):
+    content: bytes
+    mime_type: str
+    encoding: str
+    etag: str = ""
+    expires_at: float = 0.0
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return self.expires_at > (now if now is not None else time.time())
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, Tuple[object, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: str, value, size: int) -> None:
+        with self._lock:
+            if size > self.max_bytes:
+                self.pop(key)
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._data[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+
+    def pop(self, key: str):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            self.current_bytes -= item[1]
+            return item[0]
+
+    def resize(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _evict(self) -> None:
+        while self.current_bytes > self.max_bytes and self._data:
+            _key, (_value, size) = self._data.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+
+class AssetCache(LRUCache):
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, directory: Optional[str] = None, default_ttl: int = 300):
+        super().__init__(max_bytes)
+        self.directory = directory
+        self.default_ttl = default_ttl
+        self.revalidated = 0
+        # Bytes on disk, kept up to date between the directory scans that
+        # evict files; None until the first scan.
+        self._disk_size_estimate: Optional[int] = None
+
+    def configure(self, max_bytes: int, directory: Optional[str], default_ttl: int) -> None:
+        with self._lock:
+            self.default_ttl = default_ttl
+            if (directory or None) != self.directory:
+                self._disk_size_estimate = None
+            self.directory = directory or None
+            if max_bytes != self.max_bytes:
+                self.resize(max_bytes)
+
+    def get(self, key: str) -> Optional[CachedResource]:
+        entry = super().get(key)
+        if entry is None and self.directory:
+            entry = self._disk_read(key)
+            if entry is not None:
+                with self._lock:
+                    self.misses -= 1
+                    self.hits += 1
+                super().put(key, entry, len(entry.content))
+        return entry
+
+    def put(self, key: str, entry: CachedResource, size: Optional[int] = None) -> None:
+        super().put(key, entry, len(entry.content) if size is None else size)
+        if self.directory:
+            self._disk_write(key, entry)
+
+    def revalidate(self, key: str, entry: CachedResource, expires_at: float) -> CachedResource:
+        entry = entry._replace(expires_at=expires_at)
+        with self._lock:
+            self.revalidated += 1
+        self.put(key, entry)
+        return entry
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        stats["revalidated"] = self.revalidated
+        stats["directory"] = self.directory or ""
+        stats["disk_bytes"] = self._disk_size_estimate or 0
+        return stats
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _disk_read(self, key: str) -> Optional[CachedResource]:
+        path = self._disk_path(key)
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            with open(path + ".bin", "rb") as fh:
+                content = fh.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("key") != key:
+            return None
+        return CachedResource(content, meta["mime_type"], meta["encoding"], meta["etag"], meta["expires_at"])
+
+    def _disk_write(self, key: str, entry: CachedResource) -> None:
+        path = self._disk_path(key)
+        meta = {
+            "key": key,
+            "mime_type": entry.mime_type,
+            "encoding": entry.encoding,
+            "etag": entry.etag,
+            "expires_at": entry.expires_at,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".bin.tmp", "wb") as fh:
+                fh.write(entry.content)
+            os.replace(path + ".bin.tmp", path + ".bin")
+            with open(path + ".json.tmp", "w", encoding="utf-8") as fh:
+                json.dump(meta, fh)
+            os.replace(path + ".json.tmp", path + ".json")
+        except OSError:
+            _logger.warning("PlutoPrint asset cache: cannot write %s", path, exc_info=True)
+            return
+        # Like PdfResultCache: the directory is only scanned once the running
+        # total goes over the limit. Overwritten entries are counted twice
+        # until the next scan corrects the total.
+        with self._lock:
+            if self._disk_size_estimate is not None:
+                self._disk_size_estimate += len(entry.content)
+            if self._disk_size_estimate is None or self._disk_size_estimate > self.max_bytes:
+                try:
+                    self._disk_evict()
+                except OSError:
+                    _logger.warning("PlutoPrint asset cache: cannot evict from %s", self.directory, exc_info=True)
+
+    def _disk_evict(self) -> None:
+        files = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.endswith(".bin"):
+                    st = item.stat()
+                    files.append((st.st_mtime, st.st_size, item.path))
+                    total += st.st_size
+        if total > self.max_bytes:
+            for _mtime, size, bin_path in sorted(files):
+                for path in (bin_path, bin_path[:-4] + ".json"):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._disk_size_estimate = total
+
+
+def asset_cache_key(dbname: str, uid: Optional[int], url: str) -> str:
+    # Asset bundles are keyed by name and checksum, static files are public;
+    # anything else may depend on the user's access rights.
+    path = url.split("://", 1)[-1]
+    path = path[path.find("/"):] if "/" in path else "/"
+    match = _ASSET_URL_RE.search(path)
+    if match:
+        return f"{dbname}|bundle|{match.group(2)}|{match.group(1)}"
+    if _STATIC_URL_RE.match(path):
+        return f"{dbname}|static|{path}"
+    return f"{dbname}|uid={uid or 0}|{url}"
+
+
+def cache_expiry(headers: Mapping[str, str], default_ttl: int, now: Optional[float] = None) -> Optional[float]:
+    # None means "do not store"; 0.0 means "store, but revalidate before reuse".
+    now = now if now is not None else time.time()
+    directives = {}
+    for part in (headers.get("Cache-Control") or "").split(","):
+        name, _sep, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return now + max(int(directives[name]), 0)
+            except ValueError:
+                break
+    return now + default_ttl
+
+
+ASSET_CACHE = AssetCache()
+
+
+class PdfResultCache:
+    # Rendered PDFs on disk, named by the hash of their input. Least recently
+    # used files (by mtime, refreshed on every hit) go first once over max_bytes.
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size_estimate: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(html_bytes: bytes, profile, options=None) -> str:
+        digest = hashlib.sha256(repr(tuple(profile) if profile else None).encode("utf-8"))
+        if options is not None:
+            digest.update(repr(tuple(options)).encode("utf-8"))
+        digest.update(html_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".pdf")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self.put_file(key, io.BytesIO(data), len(data))
+
+    def put_file(self, key: str, fileobj: BinaryIO, size: int) -> None:
+        # Copies from the current position of fileobj, which is left at its end.
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as fh:
+                shutil.copyfileobj(fileobj, fh)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            _logger.warning("PlutoPrint PDF cache: cannot write %s", path, exc_info=True)
+            return
+        with self._lock:
+            if self._size_estimate is not None:
+                self._size_estimate += size
+            if self._size_estimate is None or self._size_estimate > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        total = 0
+        for dirpath, _dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith(".pdf"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total > self.max_bytes:
+            for _mtime, size, path in sorted(files):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+                if total <= self.max_bytes:
+                    break
+        self._size_estimate = total
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "directory": self.directory,
+                "max_bytes": self.max_bytes,
+                "bytes": self._size_estimate or 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+_pdf_caches: Dict[str, PdfResultCache] = {}
+_pdf_caches_lock = threading.Lock()
+
+
+def get_pdf_cache(directory: str, max_bytes: int) -> PdfResultCache:
+    # One cache per directory (i.e. per database filestore) and process.
+    with _pdf_caches_lock:
+        cache = _pdf_caches.get(directory)
+        if cache is None:
+            cache = _pdf_caches[directory] = PdfResultCache(directory, max_bytes)
+        cache.max_bytes = max_bytes
+        return cache
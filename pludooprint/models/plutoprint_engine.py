@@ -0,0 +1,260 @@
+import io
+import logging
+import math
+import multiprocessing
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Union
+
+from .plutoprint_cache import CachedResource
+from .plutoprint_helpers import build_engine_css
+from .plutoprint_images import ImagePolicy, optimize_data_uri
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import plutoprint
+except Exception:
+    plutoprint = None
+
+UNITS_MM = 72 / 25.4
+
+# Portrait sizes in millimetres, matching plutoprint's PAGE_SIZE_* constants.
+_PAGE_SIZES_MM = {
+    "A3": (297, 420),
+    "A4": (210, 297),
+    "A5": (148, 210),
+    "B4": (250, 353),
+    "B5": (176, 250),
+    "LETTER": (215.9, 279.4),
+    "LEGAL": (215.9, 355.6),
+    "LEDGER": (279.4, 431.8),
+}
+
+
+class RenderProfile(NamedTuple):
+    # Page geometry in points, plain floats so it can be sent to worker processes.
+    width: float
+    height: float
+    margin_top: float = 0.0
+    margin_right: float = 0.0
+    margin_bottom: float = 0.0
+    margin_left: float = 0.0
+    engine_css: str = ""
+
+
+def absolute_url(base_url: str, url: str) -> str:
+    if not (url.startswith("http://") or url.startswith("https://") or url.startswith("data:")):
+        url = urllib.parse.urljoin(base_url.rstrip("/") + "/", url.lstrip("/"))
+    return url
+
+
+def build_render_profile(paperformat, landscape: Optional[bool] = None) -> RenderProfile:
+    width, height = _PAGE_SIZES_MM["A4"]
+    if not paperformat:
+        return RenderProfile(width * UNITS_MM, height * UNITS_MM)
+
+    format_key = (paperformat.format or "").upper()
+    if format_key == "CUSTOM" and paperformat.page_width and paperformat.page_height:
+        width, height = paperformat.page_width, paperformat.page_height
+    else:
+        width, height = _PAGE_SIZES_MM.get(format_key, (width, height))
+
+    if getattr(paperformat, "orientation", None) == "Landscape":
+        width, height = max(width, height), min(width, height)
+    else:
+        width, height = min(width, height), max(width, height)
+
+    return RenderProfile(
+        width * UNITS_MM,
+        height * UNITS_MM,
+        (paperformat.margin_top or 0) * UNITS_MM,
+        (paperformat.margin_right or 0) * UNITS_MM,
+        (paperformat.margin_bottom or 0) * UNITS_MM,
+        (paperformat.margin_left or 0) * UNITS_MM,
+        build_engine_css(paperformat, {}, landscape=landscape),
+    )
+
+
+class RenderBudget(NamedTuple):
+    # Per-document limits; 0 means unlimited.
+    seconds: float = 0.0
+    pages: int = 0
+    fetch_bytes: int = 0
+
+
+class RenderBudgetExceeded(Exception):
+    pass
+
+
+def check_page_budget(book: "plutoprint.Book", max_pages: int) -> None:
+    # Called between layout and PDF output, the expensive part for long documents.
+    if max_pages:
+        pages = book.get_page_count()
+        if pages > max_pages:
+            raise RenderBudgetExceeded(f"{pages} pages, the limit is {max_pages}")
+
+
+class SpooledPdfStream(tempfile.SpooledTemporaryFile):
+    # Kept in memory up to max_size, then rolled over to a temporary file. Odoo
+    # reads report streams with getvalue(), like a BytesIO.
+    def getvalue(self) -> bytes:
+        pos = self.tell()
+        self.seek(0)
+        data = self.read()
+        self.seek(pos)
+        return data
+
+
+def new_book(profile: RenderProfile) -> "plutoprint.Book":
+    return plutoprint.Book(
+        plutoprint.PageSize(profile.width, profile.height),
+        plutoprint.PageMargins(
+            top=profile.margin_top,
+            right=profile.margin_right,
+            bottom=profile.margin_bottom,
+            left=profile.margin_left,
+        ),
+        media=plutoprint.MEDIA_TYPE_PRINT,
+    )
+
+
+def write_pdf(book: "plutoprint.Book") -> bytes:
+    output = io.BytesIO()
+    book.write_to_pdf_stream(output)
+    pdf = output.getvalue()
+    output.close()
+    return pdf
+
+
+def write_pdf_to(book: "plutoprint.Book", output: BinaryIO) -> BinaryIO:
+    # Write straight into the stream that will be handed to Odoo, rewound.
+    book.write_to_pdf_stream(output)
+    output.seek(0)
+    return output
+
+
+def write_png_pages(book: "plutoprint.Book", pages: int, dpi: float) -> List[bytes]:
+    # PNG images of the first ``pages`` pages. Canvases are in CSS pixels
+    # (96 per inch) and page sizes in points.
+    scale = dpi / 96.0
+    images = []
+    for index in range(min(pages, book.get_page_count())):
+        size = book.get_page_size_at(index)
+        canvas = plutoprint.ImageCanvas(
+            max(1, math.ceil(size.width / plutoprint.UNITS_PX * scale)),
+            max(1, math.ceil(size.height / plutoprint.UNITS_PX * scale)),
+        )
+        canvas.clear_surface(1, 1, 1, 1)
+        canvas.scale(scale, scale)
+        book.render_page(canvas, index)
+        output = io.BytesIO()
+        canvas.write_to_png_stream(output)
+        images.append(output.getvalue())
+    return images
+
+
+if plutoprint is not None:
+    class PreloadedResourceFetcher(plutoprint.ResourceFetcher):
+        # Serves resources resolved up front by the parent process; worker
+        # processes have no database cursor to resolve anything themselves.
+        # Embedded data: images are downsampled here, like in the parent.
+        def __init__(self, base_url: str, resources: Dict[str, CachedResource],
+                     image_policy: Optional[ImagePolicy] = None):
+            self.base_url = base_url
+            self.resources = resources
+            self.image_policy = image_policy
+
+        def fetch_url(self, url: str) -> "plutoprint.ResourceData":
+            if url.startswith("data:"):
+                entry = optimize_data_uri(url, self.image_policy) if self.image_policy else None
+                if entry is None:
+                    return super().fetch_url(url)
+                return plutoprint.ResourceData(entry.content, entry.mime_type, entry.encoding)
+            entry = self.resources.get(absolute_url(self.base_url, url))
+            if entry is None:
+                return plutoprint.ResourceData(b"", "application/octet-stream", "")
+            return plutoprint.ResourceData(entry.content, entry.mime_type, entry.encoding)
+
+
+_worker_resources: Dict[str, CachedResource] = {}
+_worker_started = None
+_worker_image_policy: Optional[ImagePolicy] = None
+
+# How often the parent checks for jobs over their time limit.
+_POLL_SECONDS = 0.05
+
+
+def _init_worker(resources: Dict[str, CachedResource], started=None,
+                 image_policy: Optional[ImagePolicy] = None) -> None:
+    global _worker_resources, _worker_started, _worker_image_policy
+    _worker_resources = resources
+    _worker_started = started
+    _worker_image_policy = image_policy
+
+
+def _render_job(index: int, html_bytes: bytes, profile: RenderProfile, base_url: str, max_pages: int = 0) -> bytes:
+    # Record when a worker picked the job up; the parent times it from there.
+    if _worker_started is not None:
+        _worker_started[index] = time.monotonic()
+    book = new_book(profile)
+    book.custom_resource_fetcher = PreloadedResourceFetcher(base_url, _worker_resources, _worker_image_policy)
+    book.load_data(
+        html_bytes,
+        mime_type="text/html",
+        text_encoding="utf-8",
+        base_url=base_url,
+    )
+    check_page_budget(book, max_pages)
+    return write_pdf(book)
+
+
+def _results_within(futures: list, started, timeout: float) -> list:
+    # Results in order, giving each job ``timeout`` seconds from the moment a
+    # worker started it rather than from when the parent began waiting for it,
+    # so a job queued behind others is not cut short and a stuck one is caught
+    # on time. A failed job re-raises as soon as it is done.
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        deadlines = [started[i] + timeout for i, future in enumerate(futures) if future in pending and started[i]]
+        if timeout and deadlines and min(deadlines) <= now:
+            raise FutureTimeoutError()
+        wait_for = min([deadline - now for deadline in deadlines if timeout] + [_POLL_SECONDS])
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+    return [future.result() for future in futures]
+
+
+def render_in_pool(docs: List[bytes], profile: Union[RenderProfile, List[RenderProfile]], base_url: str,
+                   resources: Dict[str, CachedResource], workers: int, timeout: float,
+                   start_method: str = "fork", max_pages: int = 0,
+                   image_policy: Optional[ImagePolicy] = None) -> List[bytes]:
+    # ``profile`` is shared by all documents or given as a list, one per
+    # document. Results come back in the order of ``docs``. A job exceeding
+    # ``timeout`` kills the pool and re-raises concurrent.futures.TimeoutError;
+    # one over ``max_pages`` raises RenderBudgetExceeded. ``image_policy``
+    # applies to data: images, the others come optimized in ``resources``.
+    context = multiprocessing.get_context(start_method)
+    started = context.RawArray("d", len(docs))
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, min(workers, len(docs))),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(resources, started, image_policy),
+    )
+    profiles = profile if isinstance(profile, list) else [profile] * len(docs)
+    try:
+        futures = [executor.submit(_render_job, index, doc, doc_profile, base_url, max_pages)
+                   for index, (doc, doc_profile) in enumerate(zip(docs, profiles))]
+        return _results_within(futures, started, timeout)
+    except FutureTimeoutError:
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
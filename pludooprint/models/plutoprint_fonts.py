@@ -0,0 +1,73 @@
+import logging
+import re
+import threading
+import urllib.parse
+from typing import Iterable, Optional
+
+from .plutoprint_assets import resolve_local_asset
+from .plutoprint_cache import CachedResource, LRUCache
+from .plutoprint_helpers import extract_resource_urls
+
+_logger = logging.getLogger(__name__)
+
+FONT_EXTENSIONS = (".woff2", ".woff", ".ttf", ".otf")
+REPORT_BUNDLES = ("web.report_assets_common", "web.report_assets_pdf")
+
+_STATIC_FONT_RE = re.compile(r"^/[^/]+/static/.+\.(?:woff2?|ttf|otf)$", re.I)
+
+
+def font_key(url: str) -> Optional[str]:
+    # Fonts shipped in an addon's static folder do not change while the process
+    # runs, whatever the query string (usually a cache-busting version) says.
+    path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    return path if _STATIC_FONT_RE.match(path) else None
+
+
+class FontRegistry(LRUCache):
+    # Static web fonts, loaded once per process and served to every Book without
+    # a fetch. Unlike the asset cache, entries never expire.
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        super().__init__(max_bytes)
+        self._preloaded = set()
+        self._preload_lock = threading.Lock()
+
+    def put(self, key: str, entry: CachedResource, size: Optional[int] = None) -> None:
+        if entry.content:
+            super().put(key, entry, len(entry.content) if size is None else size)
+
+    def preload(self, env, bundle_names: Iterable[str] = REPORT_BUNDLES) -> int:
+        # Register the fonts referenced by the report asset bundles, once per
+        # database and process. Returns the number of fonts loaded.
+        dbname = env.cr.dbname
+        with self._preload_lock:
+            if dbname in self._preloaded:
+                return 0
+            self._preloaded.add(dbname)
+        loaded = 0
+        for bundle_name in bundle_names:
+            try:
+                bundle = env["ir.qweb"]._get_asset_bundle(bundle_name, css=True, js=False)
+                attachment = bundle.css() if bundle.stylesheets else None
+            except Exception:
+                _logger.debug("PlutoPrint could not load bundle %s for font preload", bundle_name, exc_info=True)
+                continue
+            if not attachment:
+                continue
+            base = attachment.url or "/"
+            for ref in extract_resource_urls(attachment.raw or b"", css_only=True):
+                key = font_key(urllib.parse.urljoin(base, ref))
+                if key is None or self.get(key) is not None:
+                    continue
+                entry = resolve_local_asset(env, key)
+                if entry is not None and entry.content:
+                    self.put(key, entry)
+                    loaded += 1
+        return loaded
+
+    def clear(self) -> None:
+        with self._preload_lock:
+            self._preloaded.clear()
+        super().clear()
+
+
+FONT_REGISTRY = FontRegistry()
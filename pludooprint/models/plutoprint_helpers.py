@@ -1,4 +1,28 @@
-from typing import Dict, List, Optional
+import html
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from lxml import etree
+import lxml.html
+
+_SLOT_RE = re.compile(rb"<!--pludooprint-slot-(\d+)-(\d+)-->")
+_CLASS_XPATH = "//div[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]"
+_LINK_HREF_RE = re.compile(rb"""<link\b[^>]*?\bhref\s*=\s*["']([^"']+)["']""", re.I)
+_IMG_SRC_RE = re.compile(rb"""<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']""", re.I)
+_PAGE_BREAK_RE = re.compile(r"(?:page-break-(?:before|after)\s*:\s*always|break-(?:before|after)\s*:\s*page)", re.I)
+_CSS_URL_RE = re.compile(rb"""url\(\s*["']?([^"')]+?)["']?\s*\)""", re.I)
+_FONT_FACE_RE = re.compile(rb"@font-face\s*\{[^}]*\}", re.I)
+_FONT_SRC_RE = re.compile(rb"""url\(\s*["']?([^"')]+?)["']?\s*\)\s*(?:format\(\s*["']?([\w-]+)["']?\s*\))?""", re.I)
+# @font-face formats the engine never picks: legacy IE and SVG fonts.
+_UNUSED_FONT_FORMATS = (b"embedded-opentype", b"svg")
+_UNUSED_FONT_EXTENSIONS = (b".eot", b".svg")
+_SCRIPT_RE = re.compile(rb"<script\b[^>]*>.*?</script\s*>|<script\b[^>]*/>", re.I | re.S)
+_DEBUG_ATTR_RE = re.compile(rb"""\sdata-oe-[\w-]+\s*=\s*(?:"[^"]*"|'[^']*')""", re.I)
+_START_TAG_RE = re.compile(rb"""<[a-zA-Z](?:"[^"]*"|'[^']*'|[^'">])*>""")
+_CSS_TOKEN_RE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/|\s*([{};,>])\s*|\s+""", re.S)
+# Selectors for states a printed page never is in.
+_INTERACTIVE_SELECTOR_RE = re.compile(
+    r":(?:hover|focus|focus-within|focus-visible|active|visited)\b|::?selection\b|::-webkit-scrollbar|::-moz-selection")
 
 
 def _build_engine_css_template(size_css: str, mr: int, ml: int, mt: int = 2, mb: int = 2) -> str:
@@ -35,11 +59,15 @@ def _build_engine_css_template(size_css: str, mr: int, ml: int, mt: int = 2, mb:
         """
 
 
-def build_engine_css(paper, specific_args: Optional[Dict], landscape: Optional[bool]) -> str:
+def effective_landscape(specific_args: Optional[Dict], landscape: Optional[bool]) -> Optional[bool]:
     specific_args = specific_args or {}
-
     if landscape is None and specific_args.get("data-report-landscape"):
         landscape = specific_args.get("data-report-landscape") in (True, "True", "true", "1")
+    return landscape
+
+
+def build_engine_css(paper, specific_args: Optional[Dict], landscape: Optional[bool]) -> str:
+    landscape = effective_landscape(specific_args, landscape)
 
     size_css = ""
     if paper.format and paper.format != "custom":
@@ -69,3 +97,340 @@ def inject_css(doc_bytes: bytes, css_list: List[str]) -> bytes:
         injection = ("<style>" + "\n".join(css_list) + "</style>").encode("utf-8")
         return doc_bytes[:pos + len(marker)] + injection + doc_bytes[pos + len(marker):]
     return doc_bytes
+
+
+def strip_html_for_print(doc_bytes: bytes) -> bytes:
+    # The engine runs no JavaScript, and data-oe-* attributes only matter
+    # to the web editor; both are dead weight for the parser.
+    doc_bytes = _SCRIPT_RE.sub(b"", doc_bytes)
+    return _START_TAG_RE.sub(lambda tag: _DEBUG_ATTR_RE.sub(b"", tag.group(0)), doc_bytes)
+
+
+def _minify_css(css: str) -> str:
+    def _token(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return match.group(2)
+        return "" if match.group(0).startswith("/*") else " "
+    return _CSS_TOKEN_RE.sub(_token, css).strip()
+
+
+def _skip_string(css: str, pos: int) -> int:
+    quote = css[pos]
+    pos += 1
+    while pos < len(css) and css[pos] != quote:
+        pos += 2 if css[pos] == "\\" else 1
+    return pos + 1
+
+
+def _block_end(css: str, pos: int) -> int:
+    # Index of the "}" closing the block whose "{" is at pos.
+    depth = 0
+    while pos < len(css):
+        char = css[pos]
+        if char in "\"'":
+            pos = _skip_string(css, pos)
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return pos
+        pos += 1
+    return len(css)
+
+
+def _media_applies_to_print(query: str) -> bool:
+    for part in query.lower().split(","):
+        words = part.split()
+        if words[:1] == ["only"]:
+            words = words[1:]
+        if not words:
+            return True
+        if words[0] == "not":
+            if words[1:2] != ["print"]:
+                return True
+        elif words[0] in ("print", "all") or words[0].startswith("("):
+            return True
+    return False
+
+
+def _split_selectors(prelude: str) -> List[str]:
+    # Split a selector list at its top-level commas only, not at those inside
+    # :is(...)/:not(...) or in quoted attribute values.
+    selectors = []
+    depth = start = pos = 0
+    while pos < len(prelude):
+        char = prelude[pos]
+        if char in "\"'":
+            pos = _skip_string(prelude, pos)
+            continue
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            selectors.append(prelude[start:pos])
+            start = pos + 1
+        pos += 1
+    selectors.append(prelude[start:])
+    return selectors
+
+
+def _top_level(selector: str) -> str:
+    # The selector without its parenthesised arguments, attribute selectors and
+    # strings: a pseudo-class inside :not() or :is() does not make the whole
+    # selector unmatchable on paper.
+    out = []
+    depth = pos = 0
+    while pos < len(selector):
+        char = selector[pos]
+        if char in "\"'":
+            pos = _skip_string(selector, pos)
+            continue
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif depth == 0:
+            out.append(char)
+        pos += 1
+    return "".join(out)
+
+
+def _filter_css(css: str) -> str:
+    out = []
+    pos = 0
+    while pos < len(css):
+        start = pos
+        while pos < len(css) and css[pos] not in "{;":
+            pos = _skip_string(css, pos) if css[pos] in "\"'" else pos + 1
+        prelude = css[start:pos].strip()
+        if pos >= len(css) or css[pos] == ";":
+            out.append(css[start:pos + 1])
+            pos += 1
+            continue
+        end = _block_end(css, pos)
+        body = css[pos + 1:end]
+        lowered = prelude.lower()
+        if lowered.startswith("@media"):
+            if _media_applies_to_print(prelude[6:]):
+                inner = _filter_css(body)
+                if inner:
+                    out.append(prelude + "{" + inner + "}")
+        elif lowered.startswith(("@supports", "@layer", "@container")):
+            inner = _filter_css(body)
+            if inner:
+                out.append(prelude + "{" + inner + "}")
+        elif lowered.startswith("@") and "keyframes" in lowered:
+            pass
+        elif lowered.startswith("@"):
+            out.append(css[start:end + 1])
+        else:
+            selectors = [sel for sel in _split_selectors(prelude)
+                         if not _INTERACTIVE_SELECTOR_RE.search(_top_level(sel))]
+            if selectors and body.strip():
+                out.append(",".join(selectors) + "{" + body + "}")
+        pos = end + 1
+    return "".join(out)
+
+
+def clean_print_css(css: bytes) -> bytes:
+    # Minify a stylesheet and drop what cannot apply to a printed page:
+    # screen-only @media blocks, keyframes and rules for interactive states.
+    return _filter_css(_minify_css(css.decode("utf-8", "replace"))).encode("utf-8")
+
+
+def _parse_html(doc_bytes: bytes) -> etree._Element:
+    return lxml.html.fromstring(doc_bytes, parser=lxml.html.HTMLParser(encoding="utf-8"))
+
+
+def _layout_groups(root: etree._Element) -> List[List[etree._Element]]:
+    # Headers go with the next article and footers with the previous one.
+    layout_xpath = " | ".join(_CLASS_XPATH.format(k) for k in ("header", "article", "footer"))
+    groups: List[List[etree._Element]] = []
+    claimed = set()
+    pending_headers = []
+    for node in root.xpath(layout_xpath):
+        if any(parent in claimed for parent in node.iterancestors()):
+            continue
+        claimed.add(node)
+        classes = (node.get("class") or "").split()
+        if "article" in classes:
+            groups.append(pending_headers + [node])
+            pending_headers = []
+        elif "header" in classes:
+            pending_headers.append(node)
+        elif groups:
+            groups[-1].append(node)
+        else:
+            pending_headers.append(node)
+    if groups:
+        groups[-1].extend(pending_headers)
+    return groups
+
+
+def _serialize_nodes(nodes: List[etree._Element]) -> List[bytes]:
+    return [etree.tostring(node, method="html", encoding="utf-8") for node in nodes]
+
+
+class LayoutSkeleton:
+    # The document with every header/article/footer group cut out, serialized
+    # once. Documents for some of the groups are then assembled by splicing the
+    # groups' own bytes into the skeleton, like inject_css does for styles.
+    def __init__(self, root: etree._Element, groups: List[List[etree._Element]]):
+        self.groups = groups
+        for index, group in enumerate(groups):
+            for position, node in enumerate(group):
+                node.getparent().replace(node, etree.Comment(f"pludooprint-slot-{index}-{position}"))
+        pieces = _SLOT_RE.split(etree.tostring(root.getroottree(), method="html", encoding="utf-8"))
+        self.parts = pieces[::3]
+        self.slots = [(int(i), int(p)) for i, p in zip(pieces[1::3], pieces[2::3])]
+        self.group_bytes = [_serialize_nodes(group) for group in groups]
+
+    def document(self, indices: Iterable[int], group_bytes: Optional[Dict[int, List[bytes]]] = None) -> bytes:
+        # group_bytes overrides the serialization of some groups (e.g. a slice
+        # of an article).
+        wanted = set(indices)
+        group_bytes = group_bytes or {}
+        out = [self.parts[0]]
+        for (index, position), part in zip(self.slots, self.parts[1:]):
+            if index in wanted:
+                out.append(group_bytes.get(index, self.group_bytes[index])[position])
+            out.append(part)
+        return b"".join(out)
+
+
+def split_html_articles(doc_bytes: bytes) -> List[bytes]:
+    # One document per <div class="article">, sharing the <head> of the original.
+    # The tree is parsed and serialized once; see LayoutSkeleton.
+    root = _parse_html(doc_bytes)
+    groups = _layout_groups(root)
+    if len(groups) < 2:
+        return [doc_bytes]
+    skeleton = LayoutSkeleton(root, groups)
+    return [skeleton.document([index]) for index in range(len(groups))]
+
+
+def group_html_articles(doc_bytes: bytes, keys: List) -> Optional[Dict]:
+    # One document per distinct key, holding every article (with its header
+    # and footer) whose position in ``keys`` carries that key, in order. None
+    # when the document does not have exactly one article per key.
+    root = _parse_html(doc_bytes)
+    groups = _layout_groups(root)
+    if len(groups) != len(keys):
+        return None
+    if len(set(keys)) == 1:
+        return {keys[0]: doc_bytes}
+    skeleton = LayoutSkeleton(root, groups)
+    indices: Dict = {}
+    for index, key in enumerate(keys):
+        indices.setdefault(key, []).append(index)
+    return {key: skeleton.document(group) for key, group in indices.items()}
+
+
+def _page_break(node: etree._Element) -> Optional[str]:
+    if not isinstance(node.tag, str):
+        return None
+    match = _PAGE_BREAK_RE.search(node.get("style") or "")
+    if match:
+        return "after" if "after" in match.group(0).lower() else "before"
+    if "page-break" in (node.get("class") or "").split():
+        return "before"
+    return None
+
+
+def _article_segments(article: etree._Element, max_bytes: int) -> List[List[etree._Element]]:
+    # Cut the article's children at forced page breaks, then pack the pieces
+    # back together up to max_bytes.
+    pieces: List[List[etree._Element]] = [[]]
+    for kid in article:
+        kind = _page_break(kid)
+        if kind == "before" and pieces[-1]:
+            pieces.append([])
+        pieces[-1].append(kid)
+        if kind == "after":
+            pieces.append([])
+    segments: List[List[etree._Element]] = []
+    size = 0
+    for piece in filter(None, pieces):
+        piece_size = sum(len(etree.tostring(kid)) for kid in piece)
+        if segments and size + piece_size <= max_bytes:
+            segments[-1].extend(piece)
+            size += piece_size
+        else:
+            segments.append(list(piece))
+            size = piece_size
+    return segments
+
+
+def chunk_html_articles(doc_bytes: bytes, max_bytes: int) -> Iterator[bytes]:
+    # Yield documents of about max_bytes of layout content each: consecutive
+    # articles are packed together, and an article larger than that is cut at
+    # its forced page breaks. Chunks are produced lazily, one at a time.
+    root = _parse_html(doc_bytes)
+    groups = _layout_groups(root)
+    if not groups:
+        yield doc_bytes
+        return
+    skeleton = LayoutSkeleton(root, groups)
+
+    chunk: List[int] = []
+    chunk_size = 0
+    for index, group in enumerate(groups):
+        size = sum(map(len, skeleton.group_bytes[index]))
+        if chunk and chunk_size + size > max_bytes:
+            yield skeleton.document(chunk)
+            chunk, chunk_size = [], 0
+        if size <= max_bytes:
+            chunk.append(index)
+            chunk_size += size
+            continue
+
+        article = next(node for node in group if "article" in (node.get("class") or "").split())
+        segments = _article_segments(article, max_bytes)
+        kids = list(article)
+        for kid in kids:
+            article.remove(kid)
+        for segment in segments:
+            for kid in segment:
+                article.append(kid)
+            yield skeleton.document([index], {index: _serialize_nodes(group)})
+            for kid in segment:
+                article.remove(kid)
+        for kid in kids:
+            article.append(kid)
+    if chunk:
+        yield skeleton.document(chunk)
+
+
+def unused_font_urls(css: bytes) -> Set[bytes]:
+    # url()s of @font-face sources in formats the engine skips anyway.
+    unused = set()
+    for face in _FONT_FACE_RE.finditer(css):
+        for match in _FONT_SRC_RE.finditer(face.group(0)):
+            url, fmt = match.group(1).strip(), (match.group(2) or b"").lower()
+            if fmt in _UNUSED_FONT_FORMATS or url.split(b"?")[0].split(b"#")[0].lower().endswith(
+                    _UNUSED_FONT_EXTENSIONS):
+                unused.add(url)
+    return unused
+
+
+def extract_resource_urls(content: bytes, css_only: bool = False) -> List[str]:
+    # <link href>, <img src> and CSS url() references, in order and deduplicated.
+    # Attribute values are unescaped ("&amp;" -> "&") so they match the URLs
+    # the engine asks the fetcher for.
+    patterns = (_CSS_URL_RE,) if css_only else (_LINK_HREF_RE, _IMG_SRC_RE, _CSS_URL_RE)
+    skipped = unused_font_urls(content) if b"@font-face" in content else set()
+    seen = {}
+    for pattern in patterns:
+        for match in pattern.finditer(content):
+            raw = match.group(1).strip()
+            url = raw.decode("utf-8", "ignore")
+            if pattern is not _CSS_URL_RE:
+                url = html.unescape(url)
+            if url and raw not in skipped and not url.startswith(("data:", "#", "about:", "javascript:")):
+                seen.setdefault(url, None)
+    return list(seen)
@@ -0,0 +1,140 @@
+import base64
+import contextvars
+import hashlib
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from .plutoprint_cache import CachedResource, LRUCache
+from .plutoprint_metrics import count
+
+_logger = logging.getLogger(__name__)
+
+# Raster formats worth touching; SVG is vector and GIF may be animated.
+_RASTER_TYPES = ("image/jpeg", "image/png", "image/webp")
+_DATA_IMAGE_RE = re.compile(r"^data:(image/[\w.+-]+);base64,", re.I)
+
+IMAGE_CACHE = LRUCache(32 * 1024 * 1024)
+
+
+class ImagePolicy(NamedTuple):
+    max_px: int
+    quality: int = 85
+    webp_as_jpg: bool = False
+
+    @classmethod
+    def for_page(cls, page_width_pt: float, dpi: int, quality: int = 85,
+                 webp_as_jpg: bool = False) -> "ImagePolicy":
+        # No image is printed wider than the page, so more pixels than the page
+        # width holds at ``dpi`` never reach the paper.
+        return cls(max(1, int(page_width_pt / 72 * dpi)), quality, webp_as_jpg)
+
+
+def _cache_key(kind: str, content: bytes, policy: Optional[ImagePolicy], checksum: Optional[str] = None) -> str:
+    checksum = checksum or hashlib.sha1(content).hexdigest()
+    if policy is None:
+        return f"{kind}|{checksum}"
+    return f"{kind}|{checksum}|{policy.max_px}|{policy.quality}|{int(policy.webp_as_jpg)}"
+
+
+def _open(content: bytes) -> Optional[Image.Image]:
+    try:
+        img = Image.open(io.BytesIO(content))
+        img.load()
+        return img
+    except (OSError, ValueError, Image.DecompressionBombError):
+        _logger.debug("PlutoPrint could not decode image for downsampling", exc_info=True)
+        return None
+
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def optimize_image(entry: CachedResource, policy: ImagePolicy) -> CachedResource:
+    # Downsample to the policy's pixel cap and recompress JPEG (and, with
+    # webp_as_jpg, opaque WebP) as JPEG. Anything that does not end up smaller
+    # is returned unchanged.
+    if entry.mime_type not in _RASTER_TYPES or not entry.content:
+        return entry
+    key = _cache_key("img", entry.content, policy)
+    cached = IMAGE_CACHE.get(key)
+    if cached is not None:
+        return entry._replace(content=cached[0], mime_type=cached[1], encoding="")
+
+    content, mime_type = entry.content, entry.mime_type
+    img = _open(entry.content)
+    if img is not None:
+        resized = max(img.size) > policy.max_px
+        if resized:
+            img.thumbnail((policy.max_px, policy.max_px), Image.LANCZOS)
+        as_jpeg = mime_type == "image/jpeg" or (
+            mime_type == "image/webp" and policy.webp_as_jpg and not _has_alpha(img))
+        if resized or as_jpeg:
+            output = io.BytesIO()
+            if as_jpeg:
+                img.convert("RGB").save(output, format="JPEG", quality=policy.quality, optimize=True)
+                new_type = "image/jpeg"
+            else:
+                img.save(output, format="WEBP" if mime_type == "image/webp" else "PNG", optimize=True)
+                new_type = mime_type
+            if output.tell() < len(entry.content):
+                count("image_bytes_saved", len(entry.content) - output.tell())
+                count("images_optimized")
+                content, mime_type = output.getvalue(), new_type
+    IMAGE_CACHE.put(key, (content, mime_type), len(content))
+    return entry._replace(content=content, mime_type=mime_type, encoding="")
+
+
+def optimize_data_uri(url: str, policy: ImagePolicy) -> Optional[CachedResource]:
+    # optimize_image() for a base64 data: URI, which is how Odoo embeds the
+    # company logo and image fields (image_data_uri). None for any other URL.
+    match = _DATA_IMAGE_RE.match(url)
+    if not match or match.group(1).lower() not in _RASTER_TYPES:
+        return None
+    try:
+        content = base64.b64decode(url[match.end():])
+    except ValueError:
+        return None
+    return optimize_image(CachedResource(content, match.group(1).lower(), ""), policy)
+
+
+def image_to_pdf(content: bytes, policy: Optional[ImagePolicy] = None, checksum: Optional[str] = None) -> bytes:
+    # One-page PDF of an image attachment. With a policy the image is
+    # downsampled first, keeping the page the size it would have at full
+    # resolution (72 dpi) and storing it as JPEG at the policy's quality.
+    key = _cache_key("pdf", content, policy, checksum)
+    cached = IMAGE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    img = Image.open(io.BytesIO(content))
+    resolution = 72.0
+    if policy and max(img.size) > policy.max_px:
+        width = img.width
+        img.thumbnail((policy.max_px, policy.max_px), Image.LANCZOS)
+        resolution = 72.0 * img.width / width
+    output = io.BytesIO()
+    save_args = {"resolution": resolution}
+    if policy:
+        save_args["quality"] = policy.quality
+    img.convert("RGB").save(output, format="PDF", **save_args)
+    pdf = output.getvalue()
+    IMAGE_CACHE.put(key, pdf, len(pdf))
+    return pdf
+
+
+def images_to_pdf(images: List[Tuple[bytes, Optional[str]]], policy: Optional[ImagePolicy] = None,
+                  max_workers: int = 4) -> List[bytes]:
+    # image_to_pdf() over (content, checksum) pairs, in order. PIL releases the
+    # GIL while decoding and encoding, so a few threads go a long way.
+    if len(images) < 2 or max_workers < 2:
+        return [image_to_pdf(content, policy, checksum) for content, checksum in images]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(images)),
+                            thread_name_prefix="pludooprint-image") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, image_to_pdf, content, policy, checksum)
+                   for content, checksum in images]
+        return [future.result() for future in futures]
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, NamedTuple, Optional
+
+
+class FetchRecord(NamedTuple):
+    url: str
+    status: str
+    seconds: float
+    size: int
+
+
+class RenderStats:
+    def __init__(self, report_name: str):
+        self.report_name = report_name
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.durations: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.fetches: List[FetchRecord] = []
+        self._lock = threading.Lock()
+
+    @property
+    def total(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[name] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def record_fetch(self, url: str, status: str, seconds: float, size: int) -> None:
+        with self._lock:
+            self.fetches.append(FetchRecord(url, status, seconds, size))
+            self.durations["fetch"] += seconds
+            self.counters["fetch_bytes"] += size
+
+    def summary(self) -> Dict[str, object]:
+        with self._lock:
+            summary: Dict[str, object] = {
+                "report": self.report_name,
+                "total_ms": round(self.total * 1000, 2),
+            }
+            for name, seconds in sorted(self.durations.items()):
+                summary[f"{name}_ms"] = round(seconds * 1000, 2)
+            summary.update(sorted(self.counters.items()))
+            summary["fetch_count"] = len(self.fetches)
+            statuses: Dict[str, int] = defaultdict(int)
+            for fetch in self.fetches:
+                statuses[fetch.status] += 1
+            summary["fetch_status"] = dict(statuses)
+            return summary
+
+    def slowest_fetch(self) -> Optional[FetchRecord]:
+        with self._lock:
+            return max(self.fetches, key=lambda f: f.seconds, default=None)
+
+
+_current_stats: ContextVar[Optional[RenderStats]] = ContextVar("pludooprint_render_stats", default=None)
+
+
+def current_stats() -> Optional[RenderStats]:
+    return _current_stats.get()
+
+
+@contextmanager
+def track_render(report_name: str):
+    stats = RenderStats(report_name)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        stats.finished = time.perf_counter()
+        _current_stats.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    stats = _current_stats.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.add_time(name, time.perf_counter() - start)
+
+
+def count(name: str, value: int = 1) -> None:
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.count(name, value)
+
+
+def record_fetch(url: str, status: str, seconds: float, size: int) -> None:
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record_fetch(url, status, seconds, size)
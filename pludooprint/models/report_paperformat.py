@@ -0,0 +1,16 @@
+from odoo import models
+
+
+class ReportPaperformat(models.Model):
+    _inherit = "report.paperformat"
+
+    def write(self, vals):
+        res = super().write(vals)
+        # write_date does not move within a transaction; drop memoized render profiles.
+        self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
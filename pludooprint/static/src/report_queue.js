@@ -0,0 +1,58 @@
+import { _t } from "@web/core/l10n/translation";
+import { registry } from "@web/core/registry";
+import { session } from "@web/session";
+
+// Large PDF batches (pludooprint.queue_threshold) are rendered by a cron job
+// instead of the download request; the user is told so and notified again,
+// with a download button, once the PDF is ready.
+registry
+    .category("ir.actions.report handlers")
+    .add("pludooprint_queue", async (action, options, env) => {
+        const resIds = action.context?.active_ids;
+        const threshold = session.pludooprint_queue_threshold;
+        if (action.report_type !== "qweb-pdf" || !threshold || !resIds || resIds.length < threshold) {
+            return false;
+        }
+        const jobId = await env.services.orm.call("ir.actions.report", "enqueue_plutoprint_report", [
+            action.report_name,
+            resIds,
+            action.data || {},
+        ]);
+        if (!jobId) {
+            return false;
+        }
+        env.services.notification.add(
+            _t(
+                "This report covers %s records and is being generated in the background. You will be notified when it is ready.",
+                resIds.length
+            ),
+            { type: "info" }
+        );
+        return true;
+    });
+
+export const reportQueueService = {
+    dependencies: ["action", "bus_service", "notification"],
+    start(env, { action, bus_service, notification }) {
+        bus_service.subscribe("pludooprint.report_ready", ({ title, message, type, attachment_id }) => {
+            const buttons = attachment_id
+                ? [
+                      {
+                          name: _t("Download"),
+                          primary: true,
+                          onClick: () =>
+                              action.doAction({
+                                  type: "ir.actions.act_url",
+                                  url: `/web/content/${attachment_id}?download=true`,
+                                  target: "self",
+                              }),
+                      },
+                  ]
+                : [];
+            notification.add(message, { title, type, sticky: true, buttons });
+        });
+        bus_service.start();
+    },
+};
+
+registry.category("services").add("pludooprint_report_queue", reportQueueService);
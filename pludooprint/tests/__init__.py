@@ -1 +1,2 @@
-from . import test_ir_actions_report_pluto
\ No newline at end of file
+from . import test_ir_actions_report_pluto
+from . import test_benchmark_pluto
@@ -0,0 +1,206 @@
+import io
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from odoo.tests import TransactionCase, tagged
+from odoo.addons.pludooprint.models.ir_actions_report_pluto import HAS_PLUTOPRINT
+from odoo.addons.pludooprint.models.plutoprint_assets import EMPTY_RESOURCE
+
+_logger = logging.getLogger(__name__)
+
+ADDON = __package__.split('.')[2]
+TARGET = f"odoo.addons.{ADDON}.models.ir_actions_report_pluto"
+
+# Record it on the reference machine with PLUDOOPRINT_BENCH_UPDATE=1.
+BASELINE_PATH = os.environ.get(
+    "PLUDOOPRINT_BENCH_BASELINE", os.path.join(os.path.dirname(__file__), "benchmark_baseline.json"))
+DEFAULT_TOLERANCE = {"seconds": 0.25, "peak_rss_mb": 0.15}
+
+BENCH_ARCH = """
+<t t-name="pludooprint.bench_partner">
+    <t t-call="web.html_container">
+        <t t-foreach="docs" t-as="o">
+            <t t-call="web.external_layout">
+                <div class="page">
+                    <h2 t-field="o.name"/>
+                    <table class="table table-sm">
+                        <tr t-foreach="range(30)" t-as="line">
+                            <td>Line <t t-out="line"/></td>
+                            <td t-out="o.email or ''"/>
+                            <td class="text-end" t-out="line * 3.5"/>
+                        </tr>
+                    </table>
+                </div>
+            </t>
+        </t>
+    </t>
+</t>
+"""
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _PeakRss:
+    # Samples the resident set size while the block runs; ru_maxrss only ever
+    # grows, which hides the peak of every scenario after the largest one.
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+
+def _offline_fetch(session, url, key, headers, timeout, stale=None):
+    # Local stand-in for anything that is not served in-process.
+    return stale or EMPTY_RESOURCE
+
+
+@tagged("pludooprint_bench", "-standard", "post_install", "-at_install")
+class TestPlutoPrintBenchmark(TransactionCase):
+    """Throughput and peak RSS of the render pipeline, compared to a baseline.
+
+    Opt-in: ``--test-tags pludooprint_bench``. PLUDOOPRINT_BENCH_SIZES sets the
+    batch sizes (default 1,10,100,1000).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if not HAS_PLUTOPRINT:
+            raise unittest.SkipTest("PlutoPrint is not installed")
+        cls.sizes = [int(x) for x in os.environ.get("PLUDOOPRINT_BENCH_SIZES", "1,10,100,1000").split(",")]
+        ICP = cls.env["ir.config_parameter"].sudo()
+        ICP.set_param("web.base.url", "http://localhost:8069")
+        ICP.set_param("pludooprint.pdf_cache_size_mb", "0")
+        ICP.set_param("pludooprint.queue_threshold", "0")
+        ICP.set_param("pludooprint.collect_stats", "False")
+        cls.env["ir.ui.view"].create({
+            "name": "pludooprint.bench_partner",
+            "type": "qweb",
+            "key": "pludooprint.bench_partner",
+            "arch": BENCH_ARCH,
+        })
+        cls.report = cls.env["ir.actions.report"].create({
+            "name": "PlutoPrint benchmark",
+            "model": "res.partner",
+            "report_type": "qweb-pdf",
+            "report_name": "pludooprint.bench_partner",
+        })
+        cls.partners = cls.env["res.partner"].create([
+            {"name": f"Benchmark partner {i}", "email": f"bench{i}@example.com"}
+            for i in range(max(cls.sizes))
+        ])
+        cls.results = {}
+        cls.baseline = cls._load_baseline()
+        cls.startClassPatcher(patch(f"{TARGET}.fetch_remote", _offline_fetch))
+        cls.startClassPatcher(patch(
+            f"{TARGET}.fetch_remote_many",
+            lambda session, jobs, timeout, max_workers: {url: _offline_fetch(session, url, key, headers, timeout, stale)
+                                                         for url, key, headers, stale in jobs}))
+
+    @classmethod
+    def tearDownClass(cls):
+        if getattr(cls, "results", None):
+            cls._report_results(cls.results)
+        super().tearDownClass()
+
+    def _render(self, report, res_ids):
+        return self.env["ir.actions.report"].with_context(force_report_rendering=True)._render_qweb_pdf(
+            report, res_ids)[0]
+
+    def _measure(self, name, func, records):
+        func()  # warm caches so runs compare steady state
+        start = time.perf_counter()
+        with _PeakRss() as rss:
+            func()
+        seconds = time.perf_counter() - start
+        current = self.results[name] = {
+            "records": records,
+            "seconds": round(seconds, 4),
+            "records_per_s": round(records / seconds, 2) if seconds else 0.0,
+            "peak_rss_mb": round(rss.peak, 1),
+        }
+        baseline = self.baseline.get("results", {}).get(name)
+        if baseline and not os.environ.get("PLUDOOPRINT_BENCH_UPDATE"):
+            tolerance = dict(DEFAULT_TOLERANCE, **self.baseline.get("tolerance", {}))
+            for metric, allowed in tolerance.items():
+                if metric in baseline:
+                    self.assertLessEqual(
+                        current[metric], baseline[metric] * (1 + allowed),
+                        f"{name}: {metric} regressed beyond {allowed:.0%} of the baseline")
+
+    def test_batches(self):
+        for size in self.sizes:
+            ids = self.partners[:size].ids
+            self._measure(f"batch_{size}", lambda: self._render(self.report, ids), size)
+
+    def test_duplicate_ids(self):
+        size = min(10, max(self.sizes))
+        ids = self.partners[:size].ids
+        self._measure(f"duplicates_{size}", lambda: self._render(self.report, ids + ids), 2 * size)
+
+    def test_attachment_reuse(self):
+        size = min(100, max(self.sizes))
+        report = self.report.copy({
+            "attachment": "'bench-%s.pdf' % object.id",
+            "attachment_use": True,
+        })
+        ids = self.partners[:size].ids
+        self._render(report, ids)
+        self._measure(f"attachments_{size}", lambda: self._render(report, ids), size)
+
+    def test_merge_streams(self):
+        pdf = self._render(self.report, self.partners[:1].ids)
+        size = max(self.sizes)
+        Report = self.env["ir.actions.report"]
+        self._measure(
+            f"merge_{size}", lambda: Report._merge_streams([io.BytesIO(pdf) for _i in range(size)]).close(), size)
+
+    @classmethod
+    def _load_baseline(cls):
+        try:
+            with open(BASELINE_PATH, encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            _logger.warning("PlutoPrint benchmark: no baseline at %s, results are not compared", BASELINE_PATH)
+            return {}
+
+    @classmethod
+    def _report_results(cls, results):
+        _logger.info("PlutoPrint benchmark:\n%s", "\n".join(
+            f"  {name:<20} {r['records']:>5} rec {r['seconds']:>9.3f} s {r['records_per_s']:>9.2f} rec/s "
+            f"{r['peak_rss_mb']:>8.1f} MB" for name, r in sorted(results.items())))
+        if os.environ.get("PLUDOOPRINT_BENCH_UPDATE"):
+            stored = dict(cls.baseline)
+            stored["results"] = dict(stored.get("results", {}), **results)
+            stored.setdefault("tolerance", DEFAULT_TOLERANCE)
+            with open(BASELINE_PATH, "w", encoding="utf-8") as fh:
+                json.dump(stored, fh, indent=2, sort_keys=True)
+            _logger.info("PlutoPrint benchmark baseline written to %s", BASELINE_PATH)
@@ -1,9 +1,30 @@
+import base64
 import io
+import os
+import tempfile
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from unittest.mock import patch, Mock
+import lxml.html
+from PIL import Image
 from odoo.tests import TransactionCase, tagged
 from odoo.exceptions import UserError
+from odoo.service import server as odoo_server
 from odoo.tools import config
-from odoo.addons.pludooprint.models.plutoprint_helpers import build_engine_css
+from odoo.tools.image import image_data_uri
+from odoo.addons.pludooprint.models.plutoprint_assets import fetch_remote_many, resolve_local_asset
+from odoo.addons.pludooprint.models.plutoprint_cache import AssetCache, CachedResource, asset_cache_key, cache_expiry, get_pdf_cache
+from odoo.addons.pludooprint.models import plutoprint_engine
+from odoo.addons.pludooprint.models.ir_actions_report_pluto import HAS_PLUTOPRINT, IrActionsReportPluto
+from odoo.addons.pludooprint.models.plutoprint_engine import RenderBudgetExceeded, render_in_pool
+from odoo.addons.pludooprint.models.plutoprint_fonts import FontRegistry, font_key
+from odoo.addons.pludooprint.models.plutoprint_helpers import (
+    LayoutSkeleton, build_engine_css, chunk_html_articles, clean_print_css, extract_resource_urls,
+    split_html_articles, strip_html_for_print,
+)
+from odoo.addons.pludooprint.models.plutoprint_images import ImagePolicy, image_to_pdf, optimize_data_uri, optimize_image
+from odoo.addons.pludooprint.models.plutoprint_metrics import count, record_fetch, stage, track_render
 try:
     from odoo.tools.pdf import PdfWriter, PdfReader
 
@@ -42,12 +63,21 @@ ADDON = __package__.split('.')[2]
 TARGET = f"odoo.addons.{ADDON}.models.ir_actions_report_pluto"
 
 
+def _sleeping_job(index, html_bytes, profile, base_url, max_pages=0):
+    # Stand-in for plutoprint_engine._render_job in pool workers: sleeps for
+    # the number of seconds given as the document.
+    plutoprint_engine._worker_started[index] = time.monotonic()
+    time.sleep(float(html_bytes))
+    return html_bytes
+
+
 class DummyReport:
     report_name = 'test.report_name'
     model = "res.partner"
     attachment = False
     attachment_use = False
     is_invoice_report = False
+    paperformat_id = False
 
     def retrieve_attachment(self, rec):
         return None
@@ -100,6 +130,279 @@ class TestIrActionsReportPlutoHelpers(TransactionCase):
         merged.seek(0)
         reader = _read_reader(merged)
         assert _num_pages(reader) == 2, "Merged PDF should have 2 pages"
+        assert merged.getvalue().startswith(b"%PDF"), "Merged stream should expose getvalue()"
+
+    def test_merge_streams_single_stream_is_not_reparsed(self):
+        single = self._tiny_pdf()
+        with patch(f"{TARGET}.PdfFileReader") as mock_reader:
+            merged = self.Report._merge_streams([single])
+        mock_reader.assert_not_called()
+        assert merged is single
+
+    def test_split_html_articles_keeps_own_header_and_footer(self):
+        html = (b"<html><head><link href='/web/assets/a.css'/></head><body><main>"
+                b"<div class='header'>H1</div><div class='article' data-oe-id='1'>A1</div><div class='footer'>F1</div>"
+                b"<div class='header'>H2</div><div class='article' data-oe-id='2'>A2</div><div class='footer'>F2</div>"
+                b"</main></body></html>")
+        docs = split_html_articles(html)
+        assert len(docs) == 2, docs
+        assert b"H1" in docs[0] and b"A1" in docs[0] and b"F1" in docs[0], docs[0]
+        assert b"A2" not in docs[0] and b"H2" not in docs[0], docs[0]
+        assert b"H2" in docs[1] and b"A2" in docs[1] and b"F2" in docs[1], docs[1]
+        assert b"/web/assets/a.css" in docs[1], docs[1]
+
+    def test_layout_skeleton_serialized_once(self):
+        html = (b"<html><head><style>p{}</style></head><body><main>"
+                b"<div class='header'>H</div><div class='article'>A1</div>t1<div class='footer'>F1</div>"
+                b"<div class='article'>A2</div>t2<div class='footer'>F2</div>"
+                b"</main><div>after</div></body></html>")
+        root = lxml.html.document_fromstring(html)
+        skeleton = LayoutSkeleton(root, [list(root.find_class("article"))[:1], list(root.find_class("article"))[1:]])
+        assert not any(b"A1" in part or b"A2" in part for part in skeleton.parts), skeleton.parts
+        with patch("lxml.etree.tostring") as mock_tostring:
+            first, both = skeleton.document([0]), skeleton.document([0, 1])
+        mock_tostring.assert_not_called()
+        assert b"A1</div>t1" in first and b"A2" not in first and b"t2" not in first, first
+        assert b"H</div>" in first and b"F2" in first and b"<div>after</div>" in first, first
+        assert b"A1</div>t1" in both and b"A2</div>t2" in both and b"pludooprint-slot" not in both, both
+        assert skeleton.document([1], {1: [b"<div>override</div>"]}).count(b"override") == 1
+
+    def test_record_with_several_articles_gets_one_document(self):
+        html = (b"<html><head></head><body><main>"
+                b"<div class='article' data-oe-id='1'>A1a</div><div class='footer'>F</div>"
+                b"<div class='article' data-oe-id='1'>A1b</div><div class='footer'>F</div>"
+                b"<div class='article' data-oe-id='2'>A2</div><div class='footer'>F</div>"
+                b"</main></body></html>")
+        docs = self.Report._map_article_docs(html, [1, 1, 2], [1, 2])
+        assert set(docs) == {1, 2}, docs
+        assert b"A1a" in docs[1] and b"A1b" in docs[1] and b"A2" not in docs[1], docs[1]
+        assert b"A2" in docs[2] and b"A1" not in docs[2] and docs[2].count(b"F</div>") == 1, docs[2]
+        assert self.Report._map_article_docs(html, [1, 1, 2], [2, 3]) is None
+
+    def test_chunk_html_articles_splits_at_page_breaks(self):
+        rows = b"".join(
+            b"<p>row %d</p>" % i + (b"<p style='page-break-after: always;'></p>" if i % 3 == 2 else b"")
+            for i in range(9))
+        html = (b"<html><head><link href='/web/assets/1/a.css'/></head><body><main>"
+                b"<div class='header'>H</div><div class='article'>" + rows + b"</div><div class='footer'>F</div>"
+                b"<div class='article'>tail</div></main></body></html>")
+        chunks = list(chunk_html_articles(html, max_bytes=120))
+        assert len(chunks) == 4, chunks
+        assert b"row 0" in chunks[0] and b"row 3" not in chunks[0], chunks[0]
+        assert all(b"H</div>" in c and b"F</div>" in c for c in chunks[:3]), chunks
+        assert b"tail" in chunks[3] and b"row" not in chunks[3], chunks[3]
+        single = list(chunk_html_articles(html, max_bytes=10 ** 6))
+        assert len(single) == 1 and b"row 8" in single[0] and b"tail" in single[0], single
+
+    def test_pool_timeout_counts_from_job_start(self):
+        with patch.object(plutoprint_engine, "_render_job", _sleeping_job):
+            docs = [b"0.4", b"0.4", b"0.4"]
+            assert render_in_pool(docs, None, "", {}, workers=1, timeout=0.7) == docs, \
+                "Jobs queued behind others must not share the first job's time"
+            start = time.monotonic()
+            with self.assertRaises(FutureTimeoutError):
+                render_in_pool([b"0.3", b"30"], None, "", {}, workers=2, timeout=0.7)
+            assert time.monotonic() - start < 5, "A stuck job must be killed once it is over its own limit"
+
+    def test_asset_cache_lru_and_expiry(self):
+        cache = AssetCache(max_bytes=10)
+        cache.put("a", CachedResource(b"12345", "text/css", "utf-8", "", 0.0))
+        cache.put("b", CachedResource(b"12345", "text/css", "utf-8", "", 0.0))
+        assert cache.get("a") is not None
+        cache.put("c", CachedResource(b"12345", "text/css", "utf-8", "", 0.0))
+        assert cache.get("b") is None, "Least recently used entry should be evicted"
+        stats = cache.stats()
+        assert stats["hits"] == 1 and stats["misses"] == 1 and stats["evictions"] == 1, stats
+        assert cache_expiry({"Cache-Control": "no-store"}, 300, now=0) is None
+        assert cache_expiry({"Cache-Control": "public, max-age=60"}, 300, now=0) == 60
+        assert cache_expiry({}, 300, now=0) == 300
+        assert asset_cache_key("db", 2, "http://x/web/assets/abc/web.report_assets_common.min.css") == \
+            asset_cache_key("db", 7, "https://y/web/assets/abc/web.report_assets_common.min.css")
+        assert asset_cache_key("db", 2, "http://x/web/image/res.company/1/logo") != \
+            asset_cache_key("db", 7, "http://x/web/image/res.company/1/logo")
+
+    def test_asset_disk_cache_scans_only_over_the_limit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = AssetCache(max_bytes=10, directory=directory)
+            with patch(f"odoo.addons.{ADDON}.models.plutoprint_cache.os.scandir", wraps=os.scandir) as mock_scan:
+                for key in ("a", "b"):
+                    cache.put(key, CachedResource(b"12345", "text/css", "utf-8", "", 0.0))
+                assert mock_scan.call_count == 1, "Only the first write scans, to learn the size on disk"
+                cache.put("c", CachedResource(b"12345", "text/css", "utf-8", "", 0.0))
+                assert mock_scan.call_count == 2
+            assert cache.stats()["disk_bytes"] == 10
+            assert len([name for name in os.listdir(directory) if name.endswith(".bin")]) == 2
+
+    def test_resolve_local_asset_in_process(self):
+        static = resolve_local_asset(self.env, "http://localhost/web/static/img/favicon.ico")
+        assert static is not None and static.content, "Static addon files should be read from disk"
+        attachment = self.env["ir.attachment"].create({
+            "name": "pluto.txt", "raw": b"pluto", "mimetype": "text/plain"})
+        content = resolve_local_asset(self.env, f"http://localhost/web/content/{attachment.id}")
+        assert content is not None and content.content == b"pluto", content
+        assert resolve_local_asset(self.env, "http://localhost/../../etc/passwd") is None
+        assert resolve_local_asset(self.env, "http://localhost/shop/cart") is None
+        for url in ("http://localhost/report/barcode/?barcode_type=Code128&value=PLUTO&width=300&height=60",
+                    "http://localhost/report/barcode/QR/PLUTO"):
+            barcode = resolve_local_asset(self.env, url)
+            assert barcode.mime_type == "image/png" and barcode.content.startswith(b"\x89PNG"), url
+        assert not resolve_local_asset(self.env, "http://localhost/report/barcode/?barcode_type=Nope&value=x").content
+
+    def test_extract_resource_urls(self):
+        html = (b"<html><head><link rel='stylesheet' href='/web/assets/1/a.css'/>"
+                b"<style>.x{background:url('bg.png')}</style></head>"
+                b"<body><img src='https://cdn.example.com/p.png'/><img src='data:image/png;base64,AA'/>"
+                b"<img src='https://cdn.example.com/p.png'/></body></html>")
+        urls = extract_resource_urls(html)
+        assert urls == ["/web/assets/1/a.css", "https://cdn.example.com/p.png", "bg.png"], urls
+
+    def test_extracted_query_string_urls_are_unescaped(self):
+        html = (b"<html><body><img src=\"/report/barcode/?barcode_type=Code128&amp;value=X1&amp;width=600"
+                b"&amp;height=100\"/><link rel='stylesheet' href='/web/content/1?a=1&amp;b=2'/></body></html>")
+        urls = extract_resource_urls(html)
+        assert urls == ["/web/content/1?a=1&b=2",
+                        "/report/barcode/?barcode_type=Code128&value=X1&width=600&height=100"], urls
+        with patch.object(type(self.env["ir.actions.report"]), "barcode", return_value=b"\x89PNG") as mock_barcode:
+            barcode = resolve_local_asset(self.env, "http://localhost" + urls[1])
+        assert barcode.content == b"\x89PNG", barcode
+        mock_barcode.assert_called_once_with("Code128", "X1", width="600", height="100")
+
+    def test_lean_html_and_print_css(self):
+        html = (b"<html><head><script src='/web/assets/1/a.js'></script></head><body>"
+                b"<span data-oe-model='res.partner' data-oe-id='7' class='x'>Azure</span>"
+                b"<script>var s = '</div>';</script></body></html>")
+        assert strip_html_for_print(html) == b"<html><head></head><body><span class='x'>Azure</span></body></html>"
+        css = (b"/* bundle */ .a , .b > .c { color : red ; content: '{ x }' }\n"
+               b"a:hover, a.btn { color: blue }\n.btn:focus { outline: 0 }\n"
+               b"@media screen and (max-width: 768px) { .d { display: none } }\n"
+               b"@media print { .e { display: block } }\n@media (min-width: 576px) { .f { width: 50% } }\n"
+               b"@keyframes spin { from { opacity: 0 } to { opacity: 1 } }")
+        assert clean_print_css(css) == (
+            b".a,.b>.c{color : red;content: '{ x }'}a.btn{color: blue}"
+            b"@media print{.e{display: block}}@media (min-width: 576px){.f{width: 50%}}"), clean_print_css(css)
+        kept = (b".x:is(.a:hover,.b){color:red}", b"a[title='x, y:hover']{color:red}",
+                b".visually-hidden-focusable:not(:focus):not(:focus-within){position:absolute}")
+        for rule in kept:
+            assert clean_print_css(rule) == rule, clean_print_css(rule)
+        assert clean_print_css(b".a:hover .b,.c:not(.d){x:1}") == b".c:not(.d){x:1}"
+        content = b'<p data-oe-id="1">data-oe-id="7" &amp; <b data-oe-model=\'x\'>t</b></p>'
+        assert strip_html_for_print(content) == b'<p>data-oe-id="7" &amp; <b>t</b></p>', strip_html_for_print(content)
+
+    def test_font_formats_skipped_and_preloaded(self):
+        css = (b"@font-face{font-family:FA;src:url(/web/static/f/fa.eot?v=4);"
+               b"src:url(/web/static/f/fa.eot?#iefix) format('embedded-opentype'),"
+               b"url('/web/static/f/fa.woff2?v=4') format('woff2'),url(/web/static/f/fa.svg#fa) format('svg')}"
+               b".x{background:url(/web/static/img/bg.svg)}")
+        urls = extract_resource_urls(css, css_only=True)
+        assert urls == ["/web/static/f/fa.woff2?v=4", "/web/static/img/bg.svg"], urls
+        assert font_key("http://localhost/web/static/f/fa.woff2?v=4") == "/web/static/f/fa.woff2"
+        assert font_key("http://localhost/web/content/12/font.woff2") is None
+
+        registry = FontRegistry()
+        loaded = registry.preload(self.env)
+        assert loaded > 0, "Report bundles should reference static fonts"
+        assert registry.stats()["entries"] == loaded
+        assert registry.preload(self.env) == 0, "Preload runs once per database"
+
+    def test_fetch_remote_many_runs_concurrently(self):
+        def _slow_get(url, **kwargs):
+            time.sleep(0.2)
+            return Mock(status_code=200, headers={"Content-Type": "image/png", "Cache-Control": "no-store"},
+                        content=url.encode(), encoding=None)
+        session = Mock(get=_slow_get)
+        jobs = [(f"https://cdn.example.com/{i}.png", f"test|{i}", {}, None) for i in range(5)]
+        start = time.monotonic()
+        results = fetch_remote_many(session, jobs, timeout=6, max_workers=5)
+        elapsed = time.monotonic() - start
+        assert len(results) == 5 and results["https://cdn.example.com/3.png"].content.endswith(b"3.png"), results
+        assert elapsed < 0.8, f"Prefetch should not be serial ({elapsed:.2f}s)"
+
+    def test_render_profile_cached_per_paperformat(self):
+        paperformat = self.env["report.paperformat"].create({
+            "name": "Pluto test", "format": "A4", "orientation": "Portrait",
+            "margin_top": 10, "margin_bottom": 10, "margin_left": 7, "margin_right": 7})
+        first = self.Report._get_pluto_render_profile(paperformat)
+        assert self.Report._get_pluto_render_profile(paperformat) is first, "Profile should be memoized"
+        assert "size: A4;" in first.engine_css, first.engine_css
+        assert first.width < first.height, first
+        paperformat.write({"orientation": "Landscape", "margin_left": 12})
+        second = self.Report._get_pluto_render_profile(paperformat)
+        assert second is not first and second.width > second.height, second
+
+    def test_pdf_result_cache_hit_and_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = get_pdf_cache(directory, max_bytes=25)
+            first = cache.make_key(b"<html>1</html>", (595.0, 842.0))
+            second = cache.make_key(b"<html>2</html>", (595.0, 842.0))
+            assert first != cache.make_key(b"<html>1</html>", (842.0, 595.0)), "Profile must be part of the key"
+            assert cache.get(first) is None
+            cache.put(first, b"%PDF-" + b"1" * 5)
+            assert cache.get(first) == b"%PDF-11111"
+            cache.put(second, b"%PDF-" + b"2" * 15)
+            assert cache.get(first) is None, "Oldest PDF should be evicted over the size cap"
+            stats = cache.stats()
+            assert stats["hits"] == 1 and stats["misses"] == 2 and stats["evictions"] == 1, stats
+            assert abs(stats["hit_rate"] - 1 / 3) < 1e-9, stats
+            spooled = tempfile.SpooledTemporaryFile(max_size=4)
+            spooled.write(b"%PDF-" + b"3" * 5)
+            spooled.seek(0)
+            cache.put_file(first, spooled, 10)
+            assert cache.get(first) == b"%PDF-33333", "Streams are copied without being read into memory"
+
+    def test_render_stats_are_recorded(self):
+        with track_render("x.report_dummy") as stats:
+            with stage("qweb"):
+                time.sleep(0.01)
+            with stage("collect"):
+                time.sleep(0.01)
+            count("pdf_bytes", 100)
+            record_fetch("/web/assets/1/a.css", "cache", 0.002, 10)
+            record_fetch("https://cdn.example.com/p.png", "remote", 0.05, 20)
+        summary = stats.summary()
+        assert summary["qweb_ms"] >= 10 and summary["pdf_bytes"] == 100, summary
+        assert summary["fetch_count"] == 2 and summary["fetch_status"] == {"cache": 1, "remote": 1}, summary
+        report = self.Report.create({
+            "name": "Stats report", "model": "res.partner", "report_type": "qweb-pdf",
+            "report_name": "x.report_dummy"})
+        stat = self.env["pludooprint.report.stat"]._record(report, stats, 1)
+        assert stat.report_id == report and stat.report_name == "x.report_dummy", stat
+        assert stat.fetch_cache_hits == 1 and stat.slowest_url == "https://cdn.example.com/p.png", stat
+        assert stat.collect_ms >= 10 and stat.qweb_ms >= 10, stat
+        count("pdf_bytes", 1)  # no active render: must be a no-op
+
+    def test_images_downsampled_to_dpi_cap(self):
+        policy = ImagePolicy.for_page(72 * 8, 150, quality=80)
+        assert policy.max_px == 1200, policy
+        buf = io.BytesIO()
+        Image.effect_noise((3000, 1500), 60).convert("RGB").save(buf, format="JPEG", quality=98)
+        photo = CachedResource(buf.getvalue(), "image/jpeg", "", "etag", 42.0)
+        small = optimize_image(photo, policy)
+        assert Image.open(io.BytesIO(small.content)).size == (1200, 600)
+        assert len(small.content) < len(photo.content) and small.expires_at == 42.0, small[1:]
+        assert optimize_image(photo, policy) == small, "Second call should come from the cache"
+
+        buf = io.BytesIO()
+        Image.new("RGBA", (400, 40), (0, 0, 0, 0)).save(buf, format="WEBP")
+        logo = CachedResource(buf.getvalue(), "image/webp", "")
+        assert optimize_image(logo, policy._replace(webp_as_jpg=True)) == logo, "Transparent WebP stays as is"
+        svg = CachedResource(b"<svg/>", "image/svg+xml", "utf-8")
+        assert optimize_image(svg, policy) is svg
+
+        pdf = _read_reader(io.BytesIO(image_to_pdf(photo.content, policy)))
+        box = pdf.pages[0].mediabox if hasattr(pdf, "pages") else pdf.getPage(0).mediaBox
+        assert round(float(box[2])) == 3000, "Downsampling must not change the page size"
+
+    def test_embedded_logo_is_downsampled(self):
+        policy = ImagePolicy.for_page(72 * 8, 150, quality=80)
+        buf = io.BytesIO()
+        Image.effect_noise((3000, 1500), 60).convert("RGB").save(buf, format="JPEG", quality=98)
+        uri = image_data_uri(base64.b64encode(buf.getvalue()))
+        assert uri.startswith("data:image/jpeg;base64,"), uri[:40]
+        logo = optimize_data_uri(uri, policy)
+        assert logo.mime_type == "image/jpeg" and Image.open(io.BytesIO(logo.content)).size == (1200, 600)
+        assert len(logo.content) < len(buf.getvalue())
+        assert optimize_data_uri("data:image/svg+xml;base64,PHN2Zy8+", policy) is None
+        assert optimize_data_uri("data:text/plain,hello", policy) is None
 
 
 @tagged('post_install', '-at_install')
@@ -123,6 +426,7 @@ class TestIrActionsReportPlutoBehavior(TransactionCase):
             attachment = False
             attachment_use = False
             is_invoice_report = False
+            paperformat_id = False
             def retrieve_attachment(self, rec): return None
             def get_paperformat(self): return DummyPaper()
         return DummyReport()
@@ -148,6 +452,38 @@ class TestIrActionsReportPlutoBehavior(TransactionCase):
         finally:
             tools.config['test_enable'] = old
 
+    def test_warm_up_renders_reference_document(self):
+        rpt = self.Report
+        with patch.object(type(rpt), "_render_with_plutoprint", return_value=io.BytesIO(b"%PDF-1.7")) as mock_render:
+            summary = rpt._pluto_warm_up()
+        html = mock_render.call_args.args[0]
+        assert b"Reference document used to warm up" in html and b"@page" in html, html[:200]
+        assert mock_render.call_args.args[1] is None, "In-process assets need no session cookie"
+        assert summary["report"] == "pludooprint.warmup" and "qweb_ms" in summary, summary
+
+    def test_warm_up_runs_in_workers_forked_from_preloading_master(self):
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.warmup", "True")
+        saved = {key: config.get(key) for key in ("test_enable", "init", "update")}
+        config["test_enable"], config["init"], config["update"] = False, {}, {}
+        try:
+            with patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                    patch(f"{TARGET}._in_prefork_master", return_value=True), \
+                    patch(f"{TARGET}._WARM_UP_AFTER_FORK", set()), \
+                    patch(f"{TARGET}.os.register_at_fork") as mock_register, \
+                    patch(f"{TARGET}._start_warm_up") as mock_start:
+                self.Report._pluto_schedule_warm_up()
+                mock_start.assert_not_called()
+                after_fork = mock_register.call_args.kwargs["after_in_child"]
+                with patch(f"{TARGET}.odoo_server.server", Mock(spec=odoo_server.PreforkServer, pid=os.getppid())):
+                    after_fork()
+                assert mock_start.call_args.args[0].db_name == self.env.cr.dbname
+                with patch(f"{TARGET}.odoo_server.server", Mock(spec=odoo_server.PreforkServer, pid=-1)):
+                    after_fork()
+                assert mock_start.call_count == 1, "Processes forked by a worker must not warm up"
+        finally:
+            for key, value in saved.items():
+                config[key] = value
+
     def test_render_prepare_streams_raises_without_plutoprint(self):
         rpt = self.Report
         with patch.object(type(rpt), "_get_report", return_value=self._dummy_report_obj()), \
@@ -164,7 +500,8 @@ class TestIrActionsReportPlutoBehavior(TransactionCase):
             writer = _make_writer()
             _add_blank_page(writer, width=72, height=72)
             _write_writer(writer, buf)
-            return buf.getvalue()
+            buf.seek(0)
+            return buf
         with patch.object(type(rpt), "_get_report", return_value=self._dummy_report_obj()), \
                 patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
                 patch.object(type(rpt), "_render_with_plutoprint", _fake_render_with_plutoprint), \
@@ -190,3 +527,342 @@ class TestIrActionsReportPlutoBehavior(TransactionCase):
                 "pludooprint.report_dummy", data={}, res_ids=[1])
             assert 1 in result, "Expected key for res_id=1 in mapping"
             assert result[1]["stream"] is not None, "Expected a PDF stream for res_id=1"
+
+    def test_render_prepare_streams_renders_each_record_once(self):
+        rpt = self.Report
+        rendered = []
+
+        def _fake_render_with_plutoprint(self, html_bytes, cookie_header, paperformat=None):
+            rendered.append(html_bytes)
+            buf = io.BytesIO()
+            writer = _make_writer()
+            _add_blank_page(writer, width=72, height=72)
+            _write_writer(writer, buf)
+            buf.seek(0)
+            return buf
+        html = (b"<html><head></head><body><main>"
+                + b"".join(b"<div class='article' data-oe-model='res.partner' data-oe-id='%d'>R%d</div>" % (i, i)
+                           for i in (1, 2, 3))
+                + b"</main></body></html>")
+        with patch.object(type(rpt), "_get_report", return_value=self._dummy_report_obj()), \
+                patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                patch.object(type(rpt), "_render_with_plutoprint", _fake_render_with_plutoprint), \
+                patch.object(type(rpt), "_build_cookie_header_for_assets", return_value=None), \
+                patch.object(type(rpt), "_render_qweb_html", return_value=(html, "html")), \
+                patch.object(type(rpt), "_prepare_html", return_value=([], [1, 2, 3], None, None, {})):
+            result = rpt._render_qweb_pdf_prepare_streams(
+                "pludooprint.report_dummy", data={}, res_ids=[1, 2, 3])
+        assert len(rendered) == 3, "Each record should be rendered exactly once"
+        for i, doc in enumerate(rendered, start=1):
+            assert (b"R%d" % i) in doc, doc
+            assert sum(b"R%d" % j in doc for j in (1, 2, 3)) == 1, doc
+        assert all(result[i]["stream"] is not None for i in (1, 2, 3)), result
+
+    def test_attachments_retrieved_in_one_batch(self):
+        report = self.Report.create({
+            "name": "Stored partner report",
+            "model": "res.partner",
+            "report_type": "qweb-pdf",
+            "report_name": "pludooprint.stored_partner",
+            "attachment": "'partner-%s.pdf' % object.id",
+            "attachment_use": True,
+        })
+        partners = self.env["res.partner"].create([{"name": f"Stored {i}"} for i in range(3)])
+        png = io.BytesIO()
+        Image.new("RGB", (40, 20), (10, 120, 200)).save(png, format="PNG")
+        Attachment = self.env["ir.attachment"]
+        stored = Attachment.create({"name": f"partner-{partners[0].id}.pdf", "raw": b"%PDF-1.4 stored",
+                                    "res_model": "res.partner", "res_id": partners[0].id})
+        Attachment.create({"name": "other.pdf", "raw": b"%PDF-1.4 other",
+                           "res_model": "res.partner", "res_id": partners[1].id})
+        scan = Attachment.create({"name": f"partner-{partners[2].id}.pdf", "raw": png.getvalue(),
+                                  "res_model": "res.partner", "res_id": partners[2].id})
+        found = self.Report._pluto_retrieve_attachments(report, partners)
+        assert found == {partners[0].id: stored, partners[2].id: scan}, found
+        for record in partners:
+            assert found.get(record.id, Attachment) == (report.retrieve_attachment(record) or Attachment)
+        pdf = self.Report._pluto_images_to_pdf(report, [scan, scan])
+        assert len(pdf) == 2 and pdf[0] == pdf[1] and pdf[0].startswith(b"%PDF"), pdf
+
+        original = Attachment.create({"name": "original-bill.pdf", "raw": b"%PDF-1.4 original",
+                                      "res_model": "res.partner", "res_id": partners[1].id})
+
+        def _vendor_bill_override(self, record):
+            # Like account's override: its own attachment for some records,
+            # super() for the others.
+            if record == partners[1]:
+                return original
+            return IrActionsReportPluto.retrieve_attachment(self, record)
+        search = type(Attachment).search
+        with patch.object(type(self.Report), "retrieve_attachment", _vendor_bill_override), \
+                patch.object(type(Attachment), "search", autospec=True, side_effect=search) as mock_search:
+            found = self.Report._pluto_retrieve_attachments(report, partners)
+        assert found == {partners[0].id: stored, partners[1].id: original, partners[2].id: scan}, found
+        assert mock_search.call_count == 1, "Overrides must not bring back one search per record"
+
+    def test_stale_attachments_are_refreshed(self):
+        report = self.Report.create({
+            "name": "Tracked partner report",
+            "model": "res.partner",
+            "report_type": "qweb-pdf",
+            "report_name": "pludooprint.tracked_partner",
+            "attachment": "'tracked-%s.pdf' % object.id",
+            "attachment_use": True,
+        })
+        document = self.env["ir.ui.view"].create({
+            "name": "pludooprint.tracked_partner_document", "type": "qweb",
+            "key": "pludooprint.tracked_partner_document", "arch": "<t><p t-out='o.name'/></t>"})
+        self.env["ir.ui.view"].create({
+            "name": "pludooprint.tracked_partner", "type": "qweb", "key": "pludooprint.tracked_partner",
+            "arch": "<t><t t-foreach='docs' t-as='o'><t t-call='pludooprint.tracked_partner_document'/></t></t>"})
+        partners = self.env["res.partner"].create([{"name": f"Tracked {i}"} for i in range(2)])
+        streams = {p.id: {"stream": io.BytesIO(b"%PDF-1.4 v1"), "attachment": None} for p in partners}
+        vals_list = self.Report._prepare_pdf_report_attachment_vals_list(report, streams)
+        assert all(vals["pludooprint_fingerprint"].startswith(f"{report.id}:") for vals in vals_list), vals_list
+        attachments = self.env["ir.attachment"].create(vals_list)
+        assert not report._pluto_stale_attachments()
+
+        self.env.cr.execute(
+            "UPDATE res_partner SET write_date = write_date + interval '1 second' WHERE id = %s", [partners[1].id])
+        partners.invalidate_recordset(["write_date"])
+        stale = report._pluto_stale_attachments()
+        assert stale.mapped("res_id") == [partners[1].id], stale
+
+        rendered = {partners[1].id: {"stream": io.BytesIO(b"%PDF-1.4 v2"), "attachment": None}}
+        with patch.object(type(self.Report), "_render_qweb_pdf_prepare_streams", return_value=rendered) as mock_render:
+            assert report._pluto_refresh_stale_attachments() == 0, "Reports must be listed to be refreshed"
+            mock_render.assert_not_called()
+            self.env["ir.config_parameter"].sudo().set_param(
+                "pludooprint.refresh_stale_reports", "other.report, pludooprint.tracked_partner")
+            assert report._pluto_refresh_stale_attachments() == 1
+        assert mock_render.call_args.kwargs["res_ids"] == [partners[1].id]
+        assert mock_render.call_args.args[0] == report
+        assert attachments.sorted("res_id").mapped("raw") == [b"%PDF-1.4 v1", b"%PDF-1.4 v2"]
+        assert not report._pluto_stale_attachments()
+
+        self.env.cr.execute(
+            "UPDATE ir_ui_view SET write_date = write_date + interval '1 second' WHERE id = %s", [document.id])
+        document.invalidate_recordset(["write_date"])
+        assert len(report._pluto_stale_attachments()) == 2, "Editing a t-called template makes every PDF stale"
+
+    def test_no_asset_session_when_assets_are_in_process(self):
+        rpt = self.Report
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.inprocess_assets", "True")
+        with patch(f"{TARGET}.root") as mock_root:
+            assert rpt._build_cookie_header_for_assets() is None
+            mock_root.session_store.new.assert_not_called()
+
+    def test_same_host_fallback_gets_a_session_in_process_mode(self):
+        if not HAS_PLUTOPRINT:
+            self.skipTest("PlutoPrint is not installed")
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("pludooprint.inprocess_assets", "True")
+        ICP.set_param("pludooprint.font_preload", "False")
+        with patch.object(type(self.Report), "_pluto_asset_session_cookie",
+                          return_value="session_id=abc") as mock_cookie:
+            fetcher = self.Report._pluto_resource_fetcher(None)
+            assert fetcher._headers("https://cdn.example.com/web/content/1") == {}
+            mock_cookie.assert_not_called()
+            assert fetcher._headers(f"{fetcher.base_url}/report/custom/1") == {"Cookie": "session_id=abc"}
+            fetcher._headers(f"{fetcher.base_url}/report/custom/2")
+            mock_cookie.assert_called_once()
+
+    def test_prefetched_query_string_url_is_served_from_cache(self):
+        if not HAS_PLUTOPRINT:
+            self.skipTest("PlutoPrint is not installed")
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.font_preload", "False")
+        url = "https://cdn.example.com/logo.png?w=200&h=80"
+        entry = CachedResource(b"\x89PNG logo", "image/png", "")
+        html = b"<html><body><img src='https://cdn.example.com/logo.png?w=200&amp;h=80'/></body></html>"
+        fetcher = self.Report._pluto_resource_fetcher(None)
+        with patch(f"{TARGET}.fetch_remote_many", return_value={url: entry}) as mock_many, \
+                patch(f"{TARGET}.fetch_remote") as mock_fetch:
+            fetcher.prefetch(extract_resource_urls(html))
+            assert [job[0] for job in mock_many.call_args.args[1]] == [url]
+            assert fetcher.resolve(url) is entry
+        mock_fetch.assert_not_called()
+
+    def test_render_many_uses_process_pool_in_order(self):
+        rpt = self.Report
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.parallel_workers", "4")
+        docs = [b"<html><body>%d</body></html>" % i for i in range(3)]
+        fetcher = Mock(base_url="http://localhost", collect=Mock(return_value={}), over_budget=False)
+
+        def _fake_pool(docs, profile, base_url, resources, workers, timeout, start_method, max_pages,
+                       image_policy=None):
+            assert workers == 4 and resources == {}
+            return [b"pdf-" + doc for doc in docs]
+        with patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                patch(f"{TARGET}.build_render_profile", return_value=None), \
+                patch(f"{TARGET}.render_in_pool", side_effect=_fake_pool), \
+                patch.object(type(rpt), "_pluto_resource_fetcher", return_value=fetcher):
+            pdfs = rpt._render_many_with_plutoprint(docs, None, paperformat=None)
+        assert [pdf.getvalue() for pdf in pdfs] == [b"pdf-" + doc for doc in docs], pdfs
+
+    def test_mixed_company_batch_uses_each_paperformat(self):
+        rpt = self.Report
+        report = rpt.create({
+            "name": "Partner per company",
+            "model": "res.partner",
+            "report_type": "qweb-pdf",
+            "report_name": "pludooprint.partner_per_company",
+        })
+        letter = self.env["report.paperformat"].create({
+            "name": "Pluto letter", "format": "Letter", "orientation": "Portrait",
+            "margin_top": 10, "margin_bottom": 10, "margin_left": 7, "margin_right": 7})
+        other = self.env["res.company"].create({"name": "Pluto Letter Co", "paperformat_id": letter.id})
+        partners = self.env["res.partner"].create([
+            {"name": "Home", "company_id": self.env.company.id},
+            {"name": "Abroad", "company_id": other.id},
+            {"name": "Shared", "company_id": False},
+        ])
+        default = rpt._resolve_paperformat(report)
+        formats = rpt._pluto_record_paperformats(report, partners.ids, default)
+        assert [formats[p.id] for p in partners] == [self.env.company.paperformat_id or default, letter, default]
+        before = rpt._pluto_fingerprints(report, partners)
+        other.paperformat_id = letter.copy({"name": "Pluto letter 2"})
+        after = rpt._pluto_fingerprints(report, partners)
+        assert [before[p.id] == after[p.id] for p in partners] == [True, False, True], (before, after)
+        other.paperformat_id = letter
+        report.paperformat_id = letter
+        assert set(rpt._pluto_record_paperformats(report, partners.ids, letter).values()) == {letter}
+
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.parallel_workers", "2")
+        fetcher = Mock(base_url="http://localhost", collect=Mock(return_value={}), over_budget=False)
+        with patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                patch.object(type(rpt), "_pluto_resource_fetcher", return_value=fetcher), \
+                patch(f"{TARGET}.render_in_pool", return_value=[b"a", b"b"]) as mock_pool:
+            pdfs = rpt._render_many_with_plutoprint([b"<p>a</p>", b"<p>b</p>"], None, paperformats=[default, letter])
+        profiles = mock_pool.call_args.args[1]
+        assert profiles == [rpt._get_pluto_render_profile(default), rpt._get_pluto_render_profile(letter)]
+        assert "size: Letter;" in profiles[1].engine_css, profiles[1].engine_css
+        assert [pdf.getvalue() for pdf in pdfs] == [b"a", b"b"]
+
+    def test_render_budgets_fail_with_user_error(self):
+        rpt = self.Report
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("pludooprint.max_render_seconds", "5")
+        ICP.set_param("pludooprint.max_pages", "3")
+        fetcher = Mock(base_url="http://localhost", collect=Mock(return_value={}), over_budget=False)
+        with patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                patch(f"{TARGET}.build_render_profile", return_value=None), \
+                patch.object(type(rpt), "_pluto_resource_fetcher", return_value=fetcher), \
+                patch(f"{TARGET}.render_in_pool") as mock_pool:
+            mock_pool.return_value = [b"%PDF-1.7"]
+            assert rpt._render_with_plutoprint(b"<html/>", None).getvalue() == b"%PDF-1.7"
+            assert mock_pool.call_args.kwargs["timeout"] == 5.0 and mock_pool.call_args.kwargs["max_pages"] == 3
+            mock_pool.side_effect = FutureTimeoutError()
+            with self.assertRaises(UserError):
+                rpt._render_with_plutoprint(b"<html/>", None)
+            mock_pool.side_effect = RenderBudgetExceeded("9 pages, the limit is 3")
+            with self.assertRaises(UserError):
+                rpt._render_with_plutoprint(b"<html/>", None)
+            mock_pool.side_effect = BrokenProcessPool("worker killed")
+            with self.assertRaises(UserError):
+                rpt._render_with_plutoprint(b"<html/>", None)
+            with self.assertRaises(UserError):
+                rpt._render_many_with_plutoprint([b"<html/>", b"<html/>"], None)
+            mock_pool.side_effect = None
+            fetcher.over_budget = True
+            with self.assertRaises(UserError):
+                rpt._render_with_plutoprint(b"<html/>", None)
+
+    def test_chunked_render_shares_one_budget(self):
+        rpt = self.Report
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("pludooprint.max_render_seconds", "60")
+        ICP.set_param("pludooprint.max_pages", "3")
+        budgets = []
+
+        def _fake_render_with_plutoprint(self, html_bytes, cookie_header, paperformat=None):
+            budgets.append(self._pluto_render_budget())
+            buf = io.BytesIO()
+            writer = _make_writer()
+            _add_blank_page(writer)
+            _add_blank_page(writer)
+            _write_writer(writer, buf)
+            buf.seek(0)
+            return buf
+        html = (b"<html><head></head><body><main>"
+                + b"".join(b"<div class='article'><p>Chunk %d</p></div>" % i for i in range(3))
+                + b"</main></body></html>")
+        with patch.object(type(rpt), "_render_with_plutoprint", _fake_render_with_plutoprint):
+            with self.assertRaises(UserError):
+                rpt._render_chunked_with_plutoprint(html, "", None, None, max_bytes=10)
+        assert [budget.pages for budget in budgets] == [3, 1], "Chunks share the document's page budget"
+        assert 0 < budgets[1].seconds <= budgets[0].seconds <= 60, budgets
+
+    def test_preview_is_cached_per_write_date(self):
+        rpt = self.Report
+        report = rpt.create({
+            "name": "Partner preview",
+            "model": "res.partner",
+            "report_type": "qweb-pdf",
+            "report_name": "pludooprint.partner_preview",
+        })
+        letter = self.env["report.paperformat"].create({
+            "name": "Pluto preview letter", "format": "Letter", "orientation": "Portrait",
+            "margin_top": 10, "margin_bottom": 10, "margin_left": 7, "margin_right": 7})
+        company = self.env["res.company"].create({"name": "Pluto Preview Co", "paperformat_id": letter.id})
+        partner = self.env["res.partner"].create({"name": "Preview partner", "company_id": company.id})
+        html = b"<html><head></head><body><main><div class='article'>Preview partner</div></main></body></html>"
+        with patch(f"{TARGET}.HAS_PLUTOPRINT", True), \
+                patch.object(type(rpt), "_render_qweb_html", return_value=(html, "html")), \
+                patch.object(type(rpt), "_prepare_html", return_value=(
+                    [], [partner.id], None, None, {"data-report-landscape": True})), \
+                patch.object(type(rpt), "_pluto_resource_fetcher"), \
+                patch.object(type(rpt), "_pluto_load_book") as mock_load, \
+                patch(f"{TARGET}.write_png_pages", return_value=[b"\x89PNG page 1"]) as mock_png:
+            assert rpt._pluto_preview_png(report, partner.id, pages=2, dpi=50) == [b"\x89PNG page 1"]
+            doc, profile = mock_load.call_args.args[:2]
+            assert b"Preview partner" in doc and b"size: Letter landscape;" in doc, doc
+            assert profile == rpt._get_pluto_render_profile(letter), "Same page setup as the PDF"
+            assert mock_png.call_args.args[1:] == (2, 50)
+            assert rpt.get_plutoprint_preview(report.id, partner.id, pages=2, dpi=50) == ["iVBORyBwYWdlIDE="], \
+                "Previews are sent over RPC as base64"
+            assert mock_png.call_count == 1, "Second preview should come from the cache"
+            self.env.cr.execute(
+                "UPDATE res_partner SET write_date = write_date + interval '1 second' WHERE id = %s", [partner.id])
+            partner.invalidate_recordset(["write_date"])
+            rpt._pluto_preview_png(report, partner.id, pages=2, dpi=50)
+            assert mock_png.call_count == 2, "A newer write_date must invalidate the preview"
+
+    def test_queued_report_job_creates_attachment(self):
+        report = self.Report.search([("report_type", "=", "qweb-pdf")], limit=1)
+        partner = self.env["res.partner"].create({"name": "Queued"})
+        self.env.user.tz = "Asia/Tokyo"
+        job = self.env["pludooprint.report.job"].create({
+            "name": "Queued test", "report_id": report.id, "res_ids": [partner.id], "data": {}})
+        contexts = []
+
+        def _fake_render_qweb_pdf(self, report_ref, res_ids=None, data=None):
+            contexts.append(self.env.context)
+            return b"%PDF-1.4 queued", "pdf"
+        with patch.object(type(self.Report), "_render_qweb_pdf", _fake_render_qweb_pdf), \
+                patch.object(type(self.env["bus.bus"]), "_sendone") as mock_send:
+            job._run()
+        assert job.state == "done", job.error
+        assert job.attachment_id.raw == b"%PDF-1.4 queued"
+        assert job.attachment_id.res_model == "pludooprint.report.job"
+        assert contexts[0]["lang"] == self.env.user.lang and contexts[0]["tz"] == "Asia/Tokyo", contexts
+        _partner, notification_type, payload = mock_send.call_args.args
+        assert notification_type == "pludooprint.report_ready" and payload["attachment_id"] == job.attachment_id.id
+
+        attachment = job.attachment_id
+        job.date_done = "2000-01-01 00:00:00"
+        pending = job.copy({"state": "pending", "attachment_id": False, "date_done": "2000-01-01 00:00:00"})
+        self.env["pludooprint.report.job"]._gc_finished_jobs()
+        assert not job.exists() and not attachment.exists(), "Old finished jobs go with their PDF"
+        assert pending.exists()
+
+    def test_large_batches_are_queued_from_the_web_client(self):
+        report = self.Report.create({
+            "name": "Queued partners", "model": "res.partner", "report_type": "qweb-pdf",
+            "report_name": "pludooprint.queued_partner"})
+        partners = self.env["res.partner"].create([{"name": f"Queued {i}"} for i in range(3)])
+        assert not self.Report.enqueue_plutoprint_report(report.id, partners.ids), "No threshold: download"
+        self.env["ir.config_parameter"].sudo().set_param("pludooprint.queue_threshold", "2")
+        assert not self.Report.enqueue_plutoprint_report(report.id, partners[:1].ids)
+        job = self.env["pludooprint.report.job"].browse(self.Report.enqueue_plutoprint_report(report.id, partners.ids))
+        assert job.state == "pending" and job.res_ids == partners.ids and job.report_id == report, job
+        assert not self.Report.with_context(pludooprint_in_queue=True)._pluto_should_queue(partners.ids)